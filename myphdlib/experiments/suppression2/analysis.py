@@ -818,10 +818,7 @@ class PerisaccadicModulationAnalysis():
                 }
                 
                 #
-                neurons = [
-                    neuron for neuron in session.rez
-                        if neuron.timestamps.size >= minimumSpikeCount
-                ]
+                neurons = session.rez.selectNeurons(f'spikeCount >= {minimumSpikeCount}')
                 #
                 print(f'INFO[animal={session.animal}, date={session.date}]: Estimating perisaccadic modulation of visual responses for {len(neurons)} neurons')
                 batches = [
@@ -1356,7 +1353,16 @@ class ResponseClusteringAnalysis():
                 continue
             probes = session.parseVisualProbes()
             saccades = session.saccadeOnsetTimestamps()
-            for neuron in session.spikeSortingResults:
+
+            # Baseline firing rate statistics for every neuron at once
+            rez = session.spikeSortingResults
+            baselines = (
+                rez.baselineStatistics(probes['extrasaccadic']['ipsi']['timestamps'], window=(-0.2, 0)),
+                rez.baselineStatistics(probes['extrasaccadic']['contra']['timestamps'], window=(-0.2, 0)),
+                rez.baselineStatistics(saccades['ipsi'], window=(-0.4, -0.2)),
+                rez.baselineStatistics(saccades['contra'], window=(-0.4, -0.2)),
+            )
+            for iNeuron, neuron in enumerate(rez):
 
                 # Ipsi motion probes
                 t, m1 = psth2(
@@ -1366,7 +1372,7 @@ class ResponseClusteringAnalysis():
                     binsize=binsize 
                 )
                 fr1 = m1.mean(0) / binsize
-                mu1, sigma1 = neuron.describe(probes['extrasaccadic']['ipsi']['timestamps'], window=(-0.2, 0))
+                mu1, sigma1 = baselines[0][0][iNeuron], baselines[0][1][iNeuron]
                 if sigma1 == 0:
                     x1 = np.full(fr1.size, 0)
                 else:
@@ -1380,7 +1386,7 @@ class ResponseClusteringAnalysis():
                     binsize=binsize,
                 )
                 fr2 = m2.mean(0) / binsize
-                mu2, sigma2 = neuron.describe(probes['extrasaccadic']['contra']['timestamps'], window=(-0.2, 0))
+                mu2, sigma2 = baselines[1][0][iNeuron], baselines[1][1][iNeuron]
                 if sigma2 == 0:
                     x2 = np.full(fr2.size, 0)
                 else:
@@ -1394,7 +1400,7 @@ class ResponseClusteringAnalysis():
                     binsize=binsize
                 )
                 fr3 = m3.mean(0) / binsize
-                mu3, sigma3 = neuron.describe(saccades['ipsi'], window=(-0.4, -0.2))
+                mu3, sigma3 = baselines[2][0][iNeuron], baselines[2][1][iNeuron]
                 if sigma3 == 0:
                     x3 = np.full(fr3.size, 0)
                 else:
@@ -1408,7 +1414,7 @@ class ResponseClusteringAnalysis():
                     binsize=binsize
                 )
                 fr4 = m4.mean(0) / binsize
-                mu4, sigma4 = neuron.describe(saccades['contra'], window=(-0.4, -0.2))
+                mu4, sigma4 = baselines[3][0][iNeuron], baselines[3][1][iNeuron]
                 if sigma4 == 0:
                     x4 = np.full(fr4.size, 0)
                 else:
@@ -1550,15 +1556,20 @@ class PremotorActivityAnalysis():
                 'ipsi': list(),
                 'contra': list(),
             }
+
+            # Baseline firing rate statistics for every neuron at once
+            baselines = {
+                direction: session.spikeSortingResults.baselineStatistics(
+                    saccades[direction],
+                    window=tuple(np.array(window) - np.diff(window).item())
+                )
+                    for direction in ('ipsi', 'contra')
+            }
             for iRow, neuron in enumerate(session.spikeSortingResults):
 
                 #
                 for direction in ('ipsi', 'contra'):
-                    mu, sigma = neuron.describe(
-                        saccades[direction],
-                        window=np.array(window) - np.diff(window).item(),
-                        binsize=binsize
-                    )
+                    mu, sigma = baselines[direction][0][iRow], baselines[direction][1][iRow]
                     if sigma == 0:
                         z = np.full(M.shape[1], 0)
                     else:
@@ -334,9 +334,8 @@ class Session(SessionBase):
             np.abs(np.diff(self.load('exposureOnsetSignal'))),
             height=0.5,
         )
-        params = self.load('timestampGeneratorParameters')
         timestamps = np.around(
-            np.interp(peakIndices, params['xp'], params['fp']) * params['m'] + params['b'],
+            self.timestampGenerator.convert(peakIndices),
             3
         )
 
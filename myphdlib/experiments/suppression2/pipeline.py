@@ -1,9 +1,8 @@
-from myphdlib.general.toolkit import DotDict
 from myphdlib.experiments.suppression2.constants import labjackChannelMapping as LCM
 from myphdlib.experiments.suppression2.constants import samplingRateLabjack
 from myphdlib.general.session import saveSessionData, loadSessionData
 from myphdlib.general.labjack import loadLabjackData, extractLabjackEvent
-from myphdlib.general.sync import extractPulseTrains, decodePulseTrains
+from myphdlib.general.sync import extractPulseTrains, decodePulseTrains, matchBarcodes, TimestampGenerator
 from myphdlib.extensions.matplotlib import placeVerticalLines
 
 import re
@@ -23,11 +22,11 @@ def extractLabjackData(sessionObject, saveDataMatrix=True):
         ['stimulus', 'cameras', 'barcode']
     )
     for channelName, channelKey in iterable:
-        channelSignal = labjackDataMatrix[:, LCM[channelKey]]
+        channelSignal = np.asarray(labjackDataMatrix[:, LCM[channelKey]])
         saveSessionData(sessionObject, channelName, channelSignal)
 
     if saveDataMatrix:
-        saveSessionData(sessionObject, 'labjackDataMatrix', labjackDataMatrix)
+        saveSessionData(sessionObject, 'labjackDataMatrix', np.asarray(labjackDataMatrix))
 
     return
 
@@ -104,13 +103,13 @@ def extractBarcodeSignals(sessionObject):
     }
 
     # Extract labjack barcodes
-    labjackDataMatrix = loadSessionData(sessionObject, 'labjackDataMatrix')
+    labjackDataMatrix = loadSessionData(sessionObject, 'labjackDataMatrix', mmap=True)
     barcodeDigitalSignal = labjackDataMatrix[:, LCM['barcode']]
     barcodePulseTrains = extractPulseTrains(barcodeDigitalSignal, device='lj')
     barcodeValuesLabjack, barcodeIndicesLabjack = decodePulseTrains(barcodePulseTrains, device='lj')
 
     # Extract neuropixels barcodes
-    barcodePulseTrains = extractPulseTrains(str(sessionObject.timestampsFilePath), device='np')
+    barcodePulseTrains = extractPulseTrains(str(sessionObject.timestampsFilePath), device='np', compact=True)
     barcodeValuesNeuropixels, barcodeIndicesNeuropixels = decodePulseTrains(barcodePulseTrains, device='np')
 
     # Save the raw barcode data
@@ -122,7 +121,7 @@ def extractBarcodeSignals(sessionObject):
 
     return
 
-def fitTimestampGenerator(sessionObject):
+def fitTimestampGenerator(sessionObject, nSegments=1, robust=True):
     """
     """
 
@@ -137,28 +136,23 @@ def fitTimestampGenerator(sessionObject):
         'neuropixels': {'indics': None, 'values': None}
     }
 
-    # Find the shared barcode signals
-    lowerBound = np.max([barcodeValuesLabjack.min(), barcodeValuesNeuropixels.min()])
-    upperBound = np.min([barcodeValuesLabjack.max(), barcodeValuesNeuropixels.max()])
-    barcodeFilterLabjack = np.logical_and(
-        barcodeValuesLabjack >= lowerBound,
-        barcodeValuesLabjack <= upperBound
-        )
-    barcodeFilterNeuropixels = np.logical_and(
-        barcodeValuesNeuropixels >= lowerBound,
-        barcodeValuesNeuropixels <= upperBound
-    )
+    # Match the barcodes recorded by both devices
+    matches, report = matchBarcodes(barcodeValuesLabjack, barcodeValuesNeuropixels)
+    for device in ('labjack', 'neuropixels'):
+        nMissing = report['missing'][device].size
+        nDuplicates = report['duplicates'][device].size
+        if nMissing != 0 or nDuplicates != 0:
+            print(f'Warning: {nMissing} missing and {nDuplicates} duplicated barcodes recorded by {device} (animal={sessionObject.animal}, date={sessionObject.date})')
+    barcodeFilterLabjack, barcodeFilterNeuropixels = matches[:, 0], matches[:, 1]
 
-    # Apply barcode filters and zero barcode values
+    # Apply barcode filters
     barcodeValuesLabjack = barcodeValuesLabjack[barcodeFilterLabjack]
-    barcodeValuesZeroedLabjack = barcodeValuesLabjack - barcodeValuesLabjack[0]
     barcodeIndicesLabjack = barcodeIndicesLabjack[barcodeFilterLabjack]
     filteredBarcodeData['labjack']['values'] = barcodeValuesLabjack
     filteredBarcodeData['labjack']['indices'] = barcodeIndicesLabjack
 
     # 
     barcodeValuesNeuropixels = barcodeValuesNeuropixels[barcodeFilterNeuropixels]
-    barcodeValuesZeroedNeuropixels = barcodeValuesNeuropixels - barcodeValuesNeuropixels[0]
     barcodeIndicesNeuropixels = barcodeIndicesNeuropixels[barcodeFilterNeuropixels]
     filteredBarcodeData['neuropixels']['values'] = barcodeValuesNeuropixels
     filteredBarcodeData['neuropixels']['indices'] = barcodeIndicesNeuropixels
@@ -167,22 +161,19 @@ def fitTimestampGenerator(sessionObject):
     # so that these timestamps are in register with the spike timestamps
     barcodeIndicesNeuropixels -= sessionObject.ephysFirstSample
 
-    # Determine paramerts of linear equation for computing timestamps
-    xlj = barcodeValuesZeroedLabjack
-    xnp = barcodeValuesZeroedNeuropixels
-    ylj = barcodeIndicesLabjack / 1000
-    ynp = (barcodeIndicesNeuropixels) / 30000 # - barcodeIndicesNeuropixels[0]) / 30000
-    mlj = (ylj[-1] - ylj[0]) / (xlj[-1] - xlj[0])
-    mnp = (ynp[-1] - ynp[0]) / (xnp[-1] - xnp[0])
-    timestampGeneratorParameters = {
-        'm': mlj + (mnp - mlj),
-        'b': barcodeIndicesNeuropixels[0] / 30000,
-        'xp': barcodeIndicesLabjack,
-        'fp': barcodeValuesZeroedLabjack,
-    }
-    saveSessionData(sessionObject, 'timestampGeneratorParameters', timestampGeneratorParameters)
     saveSessionData(sessionObject, 'filteredBarcodeData', filteredBarcodeData)
 
+    # Fit the generator used to compute timestamps
+    timestampGenerator = TimestampGenerator().fit(
+        barcodeIndicesLabjack,
+        barcodeValuesLabjack,
+        barcodeIndicesNeuropixels,
+        barcodeValuesNeuropixels,
+        nSegments=nSegments,
+        robust=robust
+    )
+    saveSessionData(sessionObject, 'timestampGenerator', timestampGenerator.toDict())
+
     return
 
 def extractStimulusDataSN(sessionObject, dataContainer):
@@ -190,8 +181,8 @@ def extractStimulusDataSN(sessionObject, dataContainer):
     """
 
     #
-    labjackDataMatrix = sessionObject.load('labjackDataMatrix')
-    params = DotDict(sessionObject.load('timestampGeneratorParameters'))
+    labjackDataMatrix = sessionObject.load('labjackDataMatrix', mmap=True)
+    timestampGenerator = sessionObject.timestampGenerator
     with open(sessionObject.inputFilePath, 'r') as stream:
         curatedStimulusMetadata = yaml.full_load(stream)['curatedStimulusMetadata']
     with open(sessionObject.sparseNoiseMetadataFilePath, 'r') as stream:
@@ -243,7 +234,7 @@ def extractStimulusDataSN(sessionObject, dataContainer):
             continue
         else:
             timestamps = np.around(
-                np.interp(edgeIndices, params.xp, params.fp) * params.m + params.b,
+                timestampGenerator.convert(edgeIndices),
                 6
             )
             dataContainer['sn']['xy'][trialIndices, :] = coords[trialIndices, :]
@@ -256,8 +247,8 @@ def extractStimulusDataMB(sessionObject, dataContainer):
     """
     """
 
-    labjackDataMatrix = sessionObject.load('labjackDataMatrix')
-    params = DotDict(sessionObject.load('timestampGeneratorParameters'))
+    labjackDataMatrix = sessionObject.load('labjackDataMatrix', mmap=True)
+    timestampGenerator = sessionObject.timestampGenerator
     with open(sessionObject.inputFilePath, 'r') as stream:
         curatedStimulusMetadata = yaml.full_load(stream)['curatedStimulusMetadata']
     with open(sessionObject.movingBarsMetadataFilePath, 'r') as stream:
@@ -301,7 +292,7 @@ def extractStimulusDataMB(sessionObject, dataContainer):
             continue
         else:
             timestamps = np.around(
-                np.interp(edgeIndices + startIndex, params.xp, params.fp) * params.m + params.b,
+                timestampGenerator.convert(edgeIndices + startIndex),
                 3
             )
             try:
@@ -341,8 +332,8 @@ def extractStimulusDataDG(sessionObject, dataContainer):
     """
 
     #
-    labjackDataMatrix = sessionObject.load('labjackDataMatrix')
-    params = DotDict(sessionObject.load('timestampGeneratorParameters'))
+    labjackDataMatrix = sessionObject.load('labjackDataMatrix', mmap=True)
+    timestampGenerator = sessionObject.timestampGenerator
     with open(sessionObject.inputFilePath, 'r') as stream:
         curatedStimulusMetadata = yaml.full_load(stream)['curatedStimulusMetadata']
 
@@ -396,7 +387,7 @@ def extractStimulusDataDG(sessionObject, dataContainer):
 
     #
     timestamps = np.around(
-        np.interp(edgeIndices + startIndex, params.xp, params.fp) * params.m + params.b,
+        timestampGenerator.convert(edgeIndices + startIndex),
         3
     )
     trialIndices = np.delete(np.arange(nEvents), np.where(missingPulsesMask)[0])
@@ -411,8 +402,8 @@ def extractStimulusDataNG(sessionObject, dataContainer, nBlocks=20):
     """
 
     #
-    labjackDataMatrix = sessionObject.load('labjackDataMatrix')
-    params = DotDict(sessionObject.load('timestampGeneratorParameters'))
+    labjackDataMatrix = sessionObject.load('labjackDataMatrix', mmap=True)
+    timestampGenerator = sessionObject.timestampGenerator
     with open(sessionObject.inputFilePath, 'r') as stream:
         curatedStimulusMetadata = yaml.full_load(stream)['curatedStimulusMetadata']
 
@@ -456,7 +447,7 @@ def extractStimulusDataNG(sessionObject, dataContainer, nBlocks=20):
             continue
         else:
             timestamps = np.around(
-                np.interp(edgeIndices + startIndex, params.xp, params.fp) * params.m + params.b,
+                timestampGenerator.convert(edgeIndices + startIndex),
                 3
             )
             dataContainer['ng']['t'][blockIndex, :] = timestamps[:-1]
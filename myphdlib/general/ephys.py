@@ -1,16 +1,21 @@
+import os
+import pickle
 import numpy as np
 import pathlib as pl
-from myphdlib.general.toolkit import psth, smooth
+from scipy.sparse import csr_matrix
+from myphdlib.general.toolkit import psth, smooth, populationPsth
+from myphdlib.general.metrics import computeQualityMetrics
 
 class Neuron():
     """
     """
 
-    def __init__(self, clusterNumber, singleUnitData, samplingRate=30000):
+    __slots__ = ('cluster', 'clusterNumber', '_timestamps')
+
+    def __init__(self, clusterNumber, timestamps):
         self.cluster = clusterNumber
         self.clusterNumber = clusterNumber
-        clusterMask = singleUnitData[:, 0] == clusterNumber
-        self._timestamps = singleUnitData[clusterMask, 1] / samplingRate
+        self._timestamps = timestamps
         return
 
     def describe(self, event, window=(0, 0.5), binsize=0.02):
@@ -35,15 +40,39 @@ class Neuron():
 
 class SpikeSortingResults():
     """
+    Kilosort/phy results which are read lazily (arrays are memory-mapped and
+    spikes are only grouped by cluster once the neurons are needed)
     """
 
-    def __init__(self, resultsFolder, autoload=True):
+    # Kilosort/phy output files exposed as (read-only) memory-maps
+    arrayFilenames = {
+        'spikeTimes': 'spike_times.npy',
+        'spikeClusters': 'spike_clusters.npy',
+        'spikeAmplitudes': 'amplitudes.npy',
+        'spikeTemplates': 'spike_templates.npy',
+        'templates': 'templates.npy',
+        'channelPositions': 'channel_positions.npy',
+        'channelMap': 'channel_map.npy',
+    }
+
+    def __init__(self, resultsFolder, autoload=True, samplingRate=30000):
         """
         """
 
         self.resultsFolderPath = pl.Path(resultsFolder)
-        self._neurons = list()
+        self.samplingRate = samplingRate
+        self._arrays = dict()
+        self._clusterNumbers = np.array([], dtype=np.int64)
+        self._clusterLabels = np.array([], dtype=str)
+        self._neurons = None
+        self._neuronsByCluster = None
         self._index = 0
+        self._spikeTimes = None
+        self._spikeClusters = None
+        self._clusterSpikeTimes = None
+        self._clusterOffsets = None
+        self._qualityMetrics = None
+        self._binnedCounts = dict()
         if autoload:
             self.load()
 
@@ -51,32 +80,137 @@ class SpikeSortingResults():
 
     def load(self):
         """
+        Read the cluster table (spike data is read on demand)
         """
 
         if self.isComplete() == False:
             return
 
-        clusterNumbers, clusterLabels = list(), list()
-        with open(self.resultsFolderPath.joinpath('cluster_group.tsv'), 'r') as stream:
-            for line in stream.readlines()[1:]:
-                clusterNumber, clusterLabel = line.rstrip('\n').split('\t')
-                clusterNumbers.append(int(clusterNumber))
-                clusterLabels.append(clusterLabel)
-
         #
-        singleUnitData = np.hstack([
-            np.load(self.resultsFolderPath.joinpath('spike_clusters.npy')),
-            np.load(self.resultsFolderPath.joinpath('spike_times.npy'))
-        ])
+        self._clusterNumbers, self._clusterLabels = self._readClusterTable('cluster_group.tsv')
 
-        #
-        self._neurons = list()
-        for clusterNumber in clusterNumbers:
-            self._neurons.append(Neuron(clusterNumber, singleUnitData))
-        self._neurons = np.array(self._neurons)
+        # Drop anything derived from a previous load
+        self._arrays = dict()
+        self._neurons = None
+        self._neuronsByCluster = None
+        self._spikeTimes = None
+        self._spikeClusters = None
+        self._clusterSpikeTimes = None
+        self._clusterOffsets = None
+        self._qualityMetrics = None
+        self._binnedCounts = dict()
+        self._index = 0
+
+        return
+
+    def _describeResultsFiles(self, filenames):
+        """
+        Collect the name, modification time, and size of each results file
+        (used to check if a cache is up to date)
+        """
+
+        description = list()
+        for filename in filenames:
+            filePath = self.resultsFolderPath.joinpath(filename)
+            if filePath.exists():
+                stat = os.stat(filePath)
+                description.append((filename, stat.st_mtime_ns, stat.st_size))
+            else:
+                description.append((filename, None, None))
+
+        return description
+
+    def _readCache(self, filename, manifest):
+        """
+        Load a cached result if its manifest matches (otherwise returns None)
+        """
+
+        filePath = self.resultsFolderPath.joinpath(filename)
+        if filePath.exists() == False:
+            return
+
+        try:
+            with open(filePath, 'rb') as stream:
+                container = pickle.load(stream)
+            if container['manifest'] != manifest:
+                return
+        except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+            return
+
+        return container['data']
+
+    def _writeCache(self, filename, manifest, data):
+        """
+        Save a result with its manifest (failures to write are ignored)
+        """
+
+        filePath = self.resultsFolderPath.joinpath(filename)
+        temporaryFilePath = filePath.with_name(filePath.name + '.tmp')
+        try:
+            with open(temporaryFilePath, 'wb') as stream:
+                pickle.dump({'manifest': manifest, 'data': data}, stream)
+            os.replace(temporaryFilePath, filePath)
+        except OSError:
+            if temporaryFilePath.exists():
+                temporaryFilePath.unlink()
+
+        return
+
+    def _readClusterTable(self, filename):
+        """
+        Read a two-column cluster table (e.g., cluster_group.tsv)
+        """
+
+        with open(self.resultsFolderPath.joinpath(filename), 'r') as stream:
+            lines = stream.read().splitlines()[1:]
+        fields = [line.split('\t') for line in lines if line]
+        clusterNumbers = np.array([int(field[0]) for field in fields], dtype=np.int64)
+        values = np.array([field[1] if len(field) > 1 else '' for field in fields], dtype=str)
+
+        return clusterNumbers, values
+
+    def _loadArray(self, key):
+        """
+        Memory-map one of the Kilosort/phy output files
+        """
+
+        if key not in self._arrays:
+            filePath = self.resultsFolderPath.joinpath(self.arrayFilenames[key])
+            if filePath.exists() == False:
+                raise Exception(f'Could not locate {filePath.name}')
+            self._arrays[key] = np.load(filePath, mmap_mode='r')
+
+        return self._arrays[key]
+
+    def _indexSpikes(self):
+        """
+        Group spikes by cluster and sort them by time (done once)
+        """
+
+        if self._clusterSpikeTimes is not None:
+            return
 
         #
-        self._index = 0
+        spikeClusters = np.asarray(self.spikeClusters).ravel()
+        spikeTimes = np.asarray(self.spikeTimes).ravel() / self.samplingRate
+
+        # Group spikes by cluster once (CSR layout): the timestamps of the
+        # i-th neuron are clusterSpikeTimes[offsets[i, 0]: offsets[i, 1]]
+        clusterOrder = np.argsort(spikeClusters, kind='stable')
+        sortedClusters = spikeClusters[clusterOrder]
+        self._clusterSpikeTimes = spikeTimes[clusterOrder]
+        self._clusterOffsets = np.vstack([
+            np.searchsorted(sortedClusters, self._clusterNumbers, side='left'),
+            np.searchsorted(sortedClusters, self._clusterNumbers, side='right')
+        ]).T
+
+        # Keep every spike (sorted by time) for computing population PSTHs
+        if spikeTimes.size > 1 and np.any(np.diff(spikeTimes) < 0):
+            spikeOrder = np.argsort(spikeTimes, kind='stable')
+            spikeTimes = spikeTimes[spikeOrder]
+            spikeClusters = spikeClusters[spikeOrder]
+        self._spikeTimes = spikeTimes
+        self._spikeClusters = spikeClusters
 
         return
 
@@ -97,37 +231,300 @@ class SpikeSortingResults():
 
         return True
 
-    def search(self, clusterNumber):
+    @property
+    def neurons(self):
+        """
+        Neurons in the order of the cluster table (built on first access)
+        """
+
+        if self._neurons is None:
+            self._neurons = list()
+            self._neuronsByCluster = dict()
+            if len(self) != 0:
+                self._indexSpikes()
+                for clusterNumber, (start, stop) in zip(self._clusterNumbers.tolist(), self._clusterOffsets):
+                    neuron = Neuron(clusterNumber, self._clusterSpikeTimes[start: stop])
+                    self._neurons.append(neuron)
+                    self._neuronsByCluster[clusterNumber] = neuron
+            self._neurons = np.array(self._neurons)
+
+        return self._neurons
+
+    @property
+    def clusterNumbers(self):
+        return self._clusterNumbers
+
+    @property
+    def clusterLabels(self):
+        return self._clusterLabels
+
+    @property
+    def spikeTimes(self):
+        """
+        Spike times (in samples)
+        """
+
+        return self._loadArray('spikeTimes')
+
+    @property
+    def spikeClusters(self):
+        return self._loadArray('spikeClusters')
+
+    @property
+    def spikeAmplitudes(self):
+        return self._loadArray('spikeAmplitudes')
+
+    @property
+    def spikeTemplates(self):
+        return self._loadArray('spikeTemplates')
+
+    @property
+    def templates(self):
+        return self._loadArray('templates')
+
+    @property
+    def channelPositions(self):
+        return self._loadArray('channelPositions')
+
+    def psth(self, events, window=(-1, 1), binsize=None, sparse=False):
+        """
+        Compute the PSTHs of every neuron at once (see populationPsth); the
+        rows of the output follow the order of the neurons
+        """
+
+        self._indexSpikes()
+        return populationPsth(
+            self._spikeTimes,
+            self._spikeClusters,
+            events,
+            window=window,
+            binsize=binsize,
+            clusters=self._clusterNumbers,
+            sparse=sparse
+        )
+
+    def qualityMetrics(self, refractoryPeriod=0.0015, nPresenceBins=100, cache=True):
         """
+        Quality metrics for every unit (see computeQualityMetrics) as a data
+        frame indexed by cluster number
+
+        The table is cached in the results folder and only recomputed when the
+        sorting results or the parameters change
         """
 
-        for neuron in self._neurons:
-            if neuron.clusterNumber == clusterNumber:
-                return neuron
+        if len(self) == 0:
+            table = computeQualityMetrics(np.array([]), np.array([]), np.array([], dtype=np.int64))
+            table.insert(0, 'label', self._clusterLabels)
+            return table
+
+        #
+        manifest = {
+            'files': self._describeResultsFiles([
+                'cluster_group.tsv',
+                self.arrayFilenames['spikeTimes'],
+                self.arrayFilenames['spikeClusters'],
+                self.arrayFilenames['spikeAmplitudes']
+            ]),
+            'samplingRate': self.samplingRate,
+            'refractoryPeriod': refractoryPeriod,
+            'nPresenceBins': nPresenceBins
+        }
+        if self._qualityMetrics is not None and self._qualityMetrics[0] == manifest:
+            return self._qualityMetrics[1]
+
+        #
+        table = self._readCache('qualityMetrics.pkl', manifest) if cache else None
+        if table is None:
+            if self.resultsFolderPath.joinpath(self.arrayFilenames['spikeAmplitudes']).exists():
+                amplitudes = self.spikeAmplitudes
+            else:
+                amplitudes = None
+            table = computeQualityMetrics(
+                np.asarray(self.spikeTimes).ravel() / self.samplingRate,
+                self.spikeClusters,
+                self._clusterNumbers,
+                amplitudes,
+                refractoryPeriod=refractoryPeriod,
+                nPresenceBins=nPresenceBins
+            )
+            table.insert(0, 'label', self._clusterLabels)
+            if cache:
+                self._writeCache('qualityMetrics.pkl', manifest, table)
+
+        #
+        self._qualityMetrics = (manifest, table)
+
+        return table
+
+    def selectNeurons(self, query, **kwargs):
+        """
+        Select neurons with a query on the quality metrics table, e.g.,
+        "label == 'good' and presenceRatio >= 0.9"
+        """
+
+        table = self.qualityMetrics(**kwargs)
+        clusterNumbers = table.query(query).index.tolist()
+
+        return [self.search(clusterNumber) for clusterNumber in clusterNumbers]
+
+    def binnedCounts(self, resolution=0.001, cache=True):
+        """
+        Spike counts as a sparse (CSR) units x time bins matrix
+
+        Rows follow the order of the neurons and column j counts the spikes in
+        [j * resolution, (j + 1) * resolution). The matrix is cached in the
+        results folder and only rebuilt when the sorting results change
+        """
+
+        manifest = {
+            'files': self._describeResultsFiles([
+                'cluster_group.tsv',
+                self.arrayFilenames['spikeTimes'],
+                self.arrayFilenames['spikeClusters']
+            ]),
+            'samplingRate': self.samplingRate,
+            'resolution': resolution
+        }
+        if resolution in self._binnedCounts and self._binnedCounts[resolution][0] == manifest:
+            return self._binnedCounts[resolution][1]
+
+        #
+        filename = f'binnedCounts{resolution * 1000:g}ms.pkl'
+        matrix = self._readCache(filename, manifest) if cache else None
+        if matrix is None:
+            self._indexSpikes()
+            starts, stops = self._clusterOffsets.T if len(self) != 0 else (np.array([], dtype=np.int64),) * 2
+            spikeCounts = stops - starts
+
+            # Gather each unit's spikes (in the order of the neurons)
+            rowIndices = np.repeat(np.arange(len(self)), spikeCounts)
+            spikeIndices = np.arange(spikeCounts.sum()) - np.repeat(np.cumsum(spikeCounts) - spikeCounts - starts, spikeCounts)
+            columnIndices = np.floor(self._clusterSpikeTimes[spikeIndices] / resolution).astype(np.int64)
+            nBins = columnIndices.max() + 1 if columnIndices.size else 0
+
+            # Duplicate entries are summed when converting to CSR
+            matrix = csr_matrix(
+                (np.ones(columnIndices.size, dtype=np.int32), (rowIndices, columnIndices)),
+                shape=(len(self), nBins)
+            )
+            matrix.sum_duplicates()
+            if cache:
+                self._writeCache(filename, manifest, matrix)
+
+        #
+        self._binnedCounts[resolution] = (manifest, matrix)
+
+        return matrix
+
+    def _cumulativeCounts(self, binIndices, resolution=0.001):
+        """
+        Number of spikes each unit fired before the start of each bin (units x
+        binIndices.shape), computed with prefix sums over the binned counts
+        """
+
+        matrix = self.binnedCounts(resolution)
+        nUnits, nBins = matrix.shape
+        binIndices = np.clip(np.asarray(binIndices, dtype=np.int64), 0, nBins)
+
+        # Non-zero entries are sorted by unit then bin, so a single search
+        # finds every (unit, bin) pair
+        rowIndices = np.repeat(np.arange(nUnits), np.diff(matrix.indptr))
+        keys = rowIndices * (nBins + 1) + matrix.indices
+        queries = np.arange(nUnits).reshape((-1,) + (1,) * binIndices.ndim) * (nBins + 1) + binIndices
+        positions = np.searchsorted(keys, queries, side='left')
+        prefixSums = np.concatenate([[0], np.cumsum(matrix.data, dtype=np.int64)])
+        rowStarts = prefixSums[matrix.indptr[:-1]].reshape((-1,) + (1,) * binIndices.ndim)
+
+        return prefixSums[positions] - rowStarts
+
+    def alignedCounts(self, events, window=(-1, 1), binsize=0.02, resolution=0.001):
+        """
+        Event-aligned spike counts for every neuron (units x events x bins)
+
+        This is a fast approximation of psth: bin edges are rounded to the
+        resolution of the binned counts and bins are [left, right) instead of
+        (left, right], so spikes within half a resolution of an edge can land
+        in the neighbouring bin
+        """
+
+        events = np.atleast_1d(np.asarray(events, dtype=float))
+        nBins = int(round((window[1] - window[0]) / binsize))
+        edges = window[0] + np.arange(nBins + 1) * binsize
+        binIndices = np.round((events.reshape(-1, 1) + edges) / resolution).astype(np.int64)
+
+        return np.diff(self._cumulativeCounts(binIndices, resolution), axis=-1)
+
+    def windowCounts(self, events, window=(0, 0.5), resolution=0.001):
+        """
+        Number of spikes each neuron fired within a window around each event
+        (units x events, approximate in the same way as alignedCounts)
+        """
+
+        return self.alignedCounts(events, window, window[1] - window[0], resolution)[:, :, 0]
+
+    def baselineStatistics(self, events, window=(-0.2, 0)):
+        """
+        Mean and standard deviation (across events) of each neuron's firing
+        rate within a window around each event
+
+        Same quantity as Neuron.describe (the window is rounded to 10 ms and
+        spikes are counted in (start, stop]) for every neuron at once
+        """
+
+        self._indexSpikes()
+        start, stop = np.around(window, 2)
+        t, M = populationPsth(
+            self._spikeTimes,
+            self._spikeClusters,
+            events,
+            window=(start, stop),
+            clusters=self._clusterNumbers,
+            closed='right'
+        )
+        rates = M[:, :, 0] / (stop - start)
+
+        return rates.mean(1), rates.std(1)
+
+    def populationRate(self, resolution=0.001, neurons=None):
+        """
+        Summed firing rate of the neurons (all by default) in every time bin
+        """
+
+        matrix = self.binnedCounts(resolution)
+        if neurons is not None:
+            matrix = matrix[neurons]
+
+        return np.asarray(matrix.sum(0)).ravel() / resolution
+
+    def search(self, clusterNumber):
+        """
+        """
 
-        return None
+        if self._neuronsByCluster is None:
+            self.neurons # Builds the lookup table
+        return self._neuronsByCluster.get(clusterNumber)
 
     def __iter__(self):
         self._index =0
         return self
 
     def __next__(self):
-        if self._index < len(self._neurons):
-            neuron = self._neurons[self._index]
+        if self._index < len(self):
+            neuron = self.neurons[self._index]
             self._index += 1
             return neuron
         else:
             raise StopIteration()
 
     def __len__(self):
-        return len(self._neurons)
+        return len(self._clusterNumbers)
 
     def __getitem__(self, key):
         """
         """
 
         try:
-            neuron = self._neurons[key]
+            neuron = self.neurons[key]
         except:
             raise Exception() from None
 
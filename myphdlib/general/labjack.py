@@ -1,8 +1,12 @@
+import io
 import os
 import re
+import pickle
 import numpy as np
+import pandas as pd
 import pathlib as pl
-from scipy.signal import find_peaks
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Number of samples in a single LabJack dat file
 NSAMPLES = 12000
@@ -10,6 +14,9 @@ NSAMPLES = 12000
 # Number of channels sampled by the LabJack
 NCHANNELS = 9
 
+# First line with at least 7 tab-separated fields that isn't the column header
+FIRST_SAMPLE_PATTERN = re.compile(rb'^(?!Time)(?:[^\t\n]*\t){6}[^\n]*\r\n', re.MULTILINE)
+
 class LabJackError(Exception):
     pass
 
@@ -20,63 +27,356 @@ def readDataFile(dat, line_length_range=(94, np.inf)):
 
     # read out the binary file
     with open(dat, 'rb') as stream:
-        lines = stream.readlines()
+        buffer = stream.read()
 
     # Corrupted or empty dat files
-    if len(lines) == 0:
+    result = FIRST_SAMPLE_PATTERN.search(buffer)
+    if result is None:
         data = np.full((NSAMPLES, NCHANNELS), np.nan)
         return data
 
+    # extract data and convert to float with the C parser of pandas (truncated
+    # rows, stray characters, or ragged rows raise a ValueError)
+    ncols = result.group().count(b'\t') + 1
+    try:
+        data = pd.read_csv(
+            io.BytesIO(buffer[result.start():]),
+            sep='\t',
+            header=None,
+            engine='c',
+            dtype=np.float64,
+            na_filter=False
+        ).to_numpy()
+    except ValueError:
+        data = None
+    if data is None or data.shape[1] != ncols:
+        data = np.full((NSAMPLES, NCHANNELS), np.nan)
+
+    return data
+
+def _sortDataFiles(labjack_folder, fileNumberRange=(None, None)):
+    """
+    Find the dat files (within the range of file numbers) sorted by file number
+    """
+
+    files = list()
+    for file in pl.Path(labjack_folder).iterdir():
+        if file.suffix != '.dat':
+            continue
+        fileNumber = int(file.stem.split('_')[-1])
+        if fileNumberRange[0] is not None:
+            if fileNumber < fileNumberRange[0]:
+                continue
+        if fileNumberRange[1] is not None:
+            if fileNumber > fileNumberRange[1]:
+                continue
+        files.append((fileNumber, str(file)))
+
+    return [file for fileNumber, file in sorted(files)]
+
+def _describeDataFiles(files):
+    """
+    Collect the name, modification time, and size of each dat file
+    """
+
+    description = list()
+    for file in files:
+        stat = os.stat(file)
+        description.append((pl.Path(file).name, stat.st_mtime_ns, stat.st_size))
+
+    return description
+
+def _locateCacheFiles(labjack_folder):
+    """
+    Determine the paths to the cached matrix and its manifest (next to the folder)
+    """
+
+    folder = pl.Path(labjack_folder)
+    dataFilePath = folder.parent.joinpath(f'{folder.name}.npy')
+    manifestFilePath = folder.parent.joinpath(f'{folder.name}.manifest.pkl')
+
+    return dataFilePath, manifestFilePath
+
+def _openCachedData(labjack_folder, files):
+    """
+    Memory-map the cached matrix if it is up to date with the dat files
+
+    Returns the matrix and the number of samples contributed by each file or
+    None if the cache is missing or stale
+    """
+
+    dataFilePath, manifestFilePath = _locateCacheFiles(labjack_folder)
+    if dataFilePath.exists() == False or manifestFilePath.exists() == False:
+        return
+
     #
-    for iline, line in enumerate(lines):
-        if bool(re.search('.*\t.*\t.*\t.*\t.*\t.*\t.*\r\n', line.decode())) and line.decode().startswith('Time') == False:
-            break
+    try:
+        with open(manifestFilePath, 'rb') as stream:
+            manifest = pickle.load(stream)
+        if manifest['files'] != _describeDataFiles(files):
+            return
+        data = np.load(dataFilePath, mmap_mode='r')
+    except (OSError, ValueError, EOFError, KeyError, pickle.UnpicklingError):
+        return
 
-    # split into header and content
-    header  = lines[:iline ]
-    content = lines[ iline:]
+    #
+    if data.shape != (sum(manifest['samples']), NCHANNELS):
+        return
 
-    # extract data and convert to float or int
-    nrows = len(content)
-    ncols = len(content[0].decode().rstrip('\r\n').split('\t'))
-    shape = (nrows, ncols)
-    data = np.zeros(shape)
-    for iline, line in enumerate(content):
-        elements = line.decode().rstrip('\r\n').split('\t')
-        elements = [float(el) for el in elements]
-        data[iline, :] = elements
+    return data, manifest['samples']
 
-    return np.array(data)
+def _writeCachedData(labjack_folder, description, data, sampleCounts):
+    """
+    Save the matrix and its manifest (the manifest goes last so that an
+    interrupted write leaves a stale cache rather than a corrupt one)
 
-def loadLabjackData(labjack_folder, fileNumberRange=(None, None)):
+    The matrix is stored in column-major order so that each channel occupies a
+    contiguous region of the file
+    """
+
+    dataFilePath, manifestFilePath = _locateCacheFiles(labjack_folder)
+    manifest = {
+        'files': description,
+        'samples': sampleCounts
+    }
+
+    #
+    temporaryFilePath = None
+    try:
+        if manifestFilePath.exists():
+            manifestFilePath.unlink()
+        temporaryFilePath = dataFilePath.with_name(f'{dataFilePath.name}.tmp')
+        cached = np.lib.format.open_memmap(
+            temporaryFilePath,
+            mode='w+',
+            dtype=data.dtype,
+            shape=data.shape,
+            fortran_order=True
+        )
+        for iChannel in range(data.shape[1]):
+            cached[:, iChannel] = data[:, iChannel]
+        cached.flush()
+        del cached
+        os.replace(temporaryFilePath, dataFilePath)
+        temporaryFilePath = manifestFilePath.with_name(f'{manifestFilePath.name}.tmp')
+        with open(temporaryFilePath, 'wb') as stream:
+            pickle.dump(manifest, stream)
+        os.replace(temporaryFilePath, manifestFilePath)
+
+    # Not being able to cache (e.g., read-only drive) shouldn't prevent loading
+    except OSError:
+        if temporaryFilePath is not None and temporaryFilePath.exists():
+            temporaryFilePath.unlink()
+
+    return
+
+def _selectChannels(data, channels=None, dtype=None):
+    """
+    Select a subset of the channels and (optionally) convert them to another dtype
+
+    Samples are converted in blocks of files so that the full matrix never has
+    to be copied, and samples are rounded when converting to an integer dtype.
+    The selection is always returned read-only
+    """
+
+    if channels is None:
+        channels = slice(None)
+    elif np.ndim(channels) != 0:
+        channels = list(channels)
+    if dtype is None:
+        selected = data[:, channels]
+        selected.flags.writeable = False
+        return selected
+
+    #
+    dtype = np.dtype(dtype)
+    shape = (data.shape[0],) + data[:0, channels].shape[1:]
+    selected = np.empty(shape, dtype=dtype)
+    for start in range(0, data.shape[0], NSAMPLES * 100):
+        block = np.asarray(data[start: start + NSAMPLES * 100, channels])
+        if dtype.kind in ('i', 'u'):
+            if np.isnan(block).any():
+                raise LabJackError(f'Missing samples cannot be represented as {dtype}')
+            block = np.rint(block)
+        selected[start: start + NSAMPLES * 100] = block
+    selected.flags.writeable = False
+
+    return selected
+
+def _concatenateDataFiles(files, nWorkers=None):
+    """
+    Concatenate the dat files into a single preallocated matrix
+
+    Files are read by a pool of threads and each file is copied into the matrix
+    as soon as all of the preceding files are in place
+    """
+
+    if nWorkers is None:
+        nWorkers = min(32, (os.cpu_count() or 1) + 4)
+
+    # create the matrix (assuming every file is complete)
+    data = np.empty((len(files) * NSAMPLES, NCHANNELS))
+    sampleCounts = list()
+    sampleIndex = 0
+
+    # Only keep a limited number of files in flight so that memory stays bounded
+    with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+        queue = deque([
+            executor.submit(readDataFile, dat) for dat in files[:2 * nWorkers]
+        ])
+        for ifile, dat in enumerate(files):
+            mat = queue.popleft().result()
+            if ifile + 2 * nWorkers < len(files):
+                queue.append(executor.submit(readDataFile, files[ifile + 2 * nWorkers]))
+
+            #
+            if mat.shape[1] != NCHANNELS:
+                raise LabJackError(f'{mat.shape[1]} channels found in {dat} but {NCHANNELS} expected')
+            nSamples = mat.shape[0]
+            if sampleIndex + nSamples > data.shape[0]:
+                nSamplesRemaining = (len(files) - ifile - 1) * NSAMPLES
+                data.resize((sampleIndex + nSamples + nSamplesRemaining, NCHANNELS), refcheck=False)
+            data[sampleIndex: sampleIndex + nSamples] = mat
+            sampleCounts.append(nSamples)
+            sampleIndex += nSamples
+
+    # Trim off the unused rows (e.g., if the last file is incomplete)
+    data.resize((sampleIndex, NCHANNELS), refcheck=False)
+
+    return data, sampleCounts
+
+def loadLabjackData(
+    labjack_folder,
+    fileNumberRange=(None, None),
+    nWorkers=None,
+    cache=True,
+    channels=None,
+    dtype=None,
+    ):
     """
     Concatenate the dat files into a matrix of the shape N samples x N channels
+
+    If cache is True the concatenated matrix is saved next to the labjack folder
+    (<folder>.npy) and reopened memory-mapped on later calls for as long as the
+    names, modification times, and sizes of the dat files are unchanged
+
+    channels selects columns of the matrix (a single index returns a vector)
+    and dtype converts them, e.g., np.uint8 for digital lines or np.float32 for
+    analog inputs (keep the time column as float64 to preserve its precision)
+
+    The returned matrix is always read-only (copy it to modify it). Whenever
+    the cache can be used it is a column-major memory-map of the cached file,
+    whether the cache was just written or already up to date
     """
 
     # determine the correct sequence of files
-    files = [
-        str(file)
-            for file in pl.Path(labjack_folder).iterdir() if file.suffix == '.dat'
-    ]
-    file_numbers = [int(file.rstrip('.dat').split('_')[-1]) for file in files]
-    sort_index = np.argsort(file_numbers)
-
-    # create the matrix
-    data = list()
-    for ifile in sort_index:
-        if fileNumberRange[0] is not None:
-            if ifile < fileNumberRange[0]:
-                continue
-        if fileNumberRange[1] is not None:
-            if ifile > fileNumberRange[1]:
-                continue
-        dat = os.path.join(labjack_folder, files[ifile])
-        mat = readDataFile(dat)
-        for irow in range(mat.shape[0]):
-            data.append(mat[irow,:].tolist())
+    files = _sortDataFiles(labjack_folder, fileNumberRange)
+    if cache == False:
+        data, sampleCounts = _concatenateDataFiles(files, nWorkers)
+        return _selectChannels(data, channels, dtype)
+
+    # Try to slice the requested files out of the cached matrix
+    allFiles = _sortDataFiles(labjack_folder)
+    result = _openCachedData(labjack_folder, allFiles)
+    if result is not None:
+        data, sampleCounts = result
+        if len(files) == 0:
+            return _selectChannels(data[:0], channels, dtype)
+        ifile = allFiles.index(files[0])
+        start = sum(sampleCounts[:ifile])
+        stop = start + sum(sampleCounts[ifile: ifile + len(files)])
+        return _selectChannels(data[start: stop], channels, dtype)
+
+    # Only the complete set of files is cached
+    description = _describeDataFiles(allFiles)
+    data, sampleCounts = _concatenateDataFiles(files, nWorkers)
+    if len(files) == len(allFiles):
+        _writeCachedData(labjack_folder, description, data, sampleCounts)
+
+        # Serve the matrix from the cache (like a cache hit) once it is written
+        result = _openCachedData(labjack_folder, allFiles)
+        if result is not None:
+            data, sampleCounts = result
+
+    return _selectChannels(data, channels, dtype)
+
+def _filterPulses(rising, falling, pulseWidthRange=(None, None)):
+    """
+    Drop the pulses (pairs of rising and falling edges) whose width in samples
+    falls outside of the range
+    """
+
+    pulseWidths = falling - rising
+    mask = np.full(pulseWidths.size, True)
+    if pulseWidthRange[0] is not None:
+        mask &= pulseWidths >= pulseWidthRange[0]
+    if pulseWidthRange[1] is not None:
+        mask &= pulseWidths <= pulseWidthRange[1]
+
+    return rising[mask], falling[mask]
+
+def _selectEdges(rising, falling, edge='both'):
+    """
+    Return the rising, falling, or all (sorted) edges
+    """
+
+    if edge == 'rising':
+        return rising
+    elif edge == 'falling':
+        return falling
+    elif edge == 'both':
+        return np.sort(np.concatenate([rising, falling]))
+    else:
+        raise ValueError(f'Edge kwarg must be "rising", "falling", or "both"')
+
+def extractLabjackEvents(data, specs):
+    """
+    Find the edges of several channels in a single pass over the matrix
+
+    Each spec is a dictionary with the keys
+        channel: column of the matrix
+        edge: "rising", "falling", or "both" (default)
+        analog: binarize at 10% of the signal's range (default False)
+        threshold: absolute threshold for binarizing the signal (default 0.5)
+        pulseWidthRange: range of pulse widths in samples (default (None, None))
+
+    Returns a list with the edge indices for each spec (the indices point to the
+    first sample after the state transition)
+    """
+
+    # Binarize all of the channels into a single channels x samples matrix
+    nSamples = data.shape[0]
+    state = np.zeros((len(specs), nSamples), dtype=bool)
+    for ispec, spec in enumerate(specs):
+        signal = data[:, spec['channel']]
+        if spec.get('analog', False):
+            minimum, maximum = np.nanmin(signal), np.nanmax(signal)
+            np.greater_equal(signal, minimum + 0.1 * (maximum - minimum), out=state[ispec])
+        else:
+            np.greater(signal, spec.get('threshold', 0.5), out=state[ispec])
+
+    # Find every state change at once (sorted by channel and then by sample)
+    flatIndices = np.flatnonzero(state[:, 1:] != state[:, :-1])
+    channelIndices, sampleIndices = np.divmod(flatIndices, max(nSamples - 1, 1))
+    sampleIndices += 1
+    isRising = state[channelIndices, sampleIndices]
+    splits = np.searchsorted(channelIndices, np.arange(len(specs) + 1))
 
     #
-    return np.array(data)
+    events = list()
+    for ispec, spec in enumerate(specs):
+        start, stop = splits[ispec], splits[ispec + 1]
+        rising = sampleIndices[start: stop][isRising[start: stop]]
+        falling = sampleIndices[start: stop][~isRising[start: stop]]
+        pulseWidthRange = spec.get('pulseWidthRange', (None, None))
+        if pulseWidthRange[0] is not None or pulseWidthRange[1] is not None:
+            if falling.size != 0 and (rising.size == 0 or falling[0] < rising[0]):
+                falling = falling[1:] # No rising edge (the signal starts high)
+            rising = rising[:falling.size] # No falling edge (the signal ends high)
+            rising, falling = _filterPulses(rising, falling, pulseWidthRange)
+        events.append(_selectEdges(rising, falling, spec.get('edge', 'both')))
+
+    return events
 
 def extractLabjackEvent(
     data,
@@ -91,6 +391,12 @@ def extractLabjackEvent(
     #
     event = data[:, iev].flatten()
 
+    # Edges are found from the thresholded state, but the returned signal is
+    # signed so that callers can still take its difference (a uint8 line would
+    # wrap around to 255 at every falling edge)
+    if event.dtype.kind == 'u':
+        event = event.astype(np.int16)
+
     # Rescale analog signal and binarize
     if analog:
         m = 1 / (event.max() - event.min())
@@ -100,134 +406,166 @@ def extractLabjackEvent(
         event[event >= 0.1] = 1
         event = event.astype(int)
 
-    # find all edges
-    rising = find_peaks(np.diff(event), height=0.9)[0]
-    falling = find_peaks(np.diff(event) * -1, height=0.9)[0]
-    if rising.size == 0 or falling.size == 0:
-        return event, np.array([])
-    if rising[0] < falling[0]:
-        firstEdge = 'rising'
-    else:
-        firstEdge = 'falling'
-    edges  = np.sort(np.concatenate([rising, falling]))
-
     #
-    exclude = list()
-    if pulseWidthRange[0] != None:
-        pulseWidths = np.abs(falling - rising)
-        for pulseIndex in np.where(pulseWidths < pulseWidthRange[0])[0]:
-            exclude.append(pulseIndex)
-
-    if pulseWidthRange[1] != None:
-        pulseWidths = np.abs(falling - rising)
-        for pulseIndex in np.where(pulseWidths > pulseWidthRange[1])[0]:
-            exclude.append(pulseIndex)
-
-    exclude = np.unique(exclude)
-    if len(exclude) > 0:
-        mask = np.full(edges.size, 1).astype(bool)
-        for pulseIndex in exclude:
-            mask[round(pulseIndex * 2)] = False
-            mask[round(pulseIndex * 2 + 1)] = False
-        edges = edges[mask]
-
-    # parse indice by the target edge
-    if edge == 'rising':
-        if firstEdge == 'rising':
-            indices = edges[0::2]
-        else:
-            indices = edges[1::2]
-    elif edge == 'falling':
-        if firstEdge == 'rising':
-            indices = edges[1::2]
-        else:
-            indices = edges[0::2]
-    elif edge == 'both':
-        indices = edges
-    else:
+    spec = {
+        'channel': iev,
+        'edge': edge,
+        'analog': analog,
+        'pulseWidthRange': pulseWidthRange
+    }
+    indices = extractLabjackEvents(data, [spec])[0]
+
+    return event, indices
+
+def iterateLabjackEvents(
+    labjack_folder,
+    iev=0,
+    edge='both',
+    threshold=0.5,
+    pulseWidthRange=(None, None),
+    fileNumberRange=(None, None),
+    ):
+    """
+    Walk through the dat files one at a time and yield the indices of the edges
+    found in each file (indices count samples from the start of the first file
+    and point to the first sample after the state transition)
+
+    The state of the signal carries over from one file to the next so that
+    edges and pulses which straddle the boundary between files are found. If a
+    pulse width range (in samples) is given only complete pulses are yielded
+    and the rising edge of a pulse is held back until its falling edge is found
+    """
+
+    if edge not in ('rising', 'falling', 'both'):
         raise ValueError(f'Edge kwarg must be "rising", "falling", or "both"')
+    filterPulses = pulseWidthRange[0] is not None or pulseWidthRange[1] is not None
 
-    # offset by 1 (this gives you the first index after the state transition)
-    indices += 1
+    #
+    previousState = None
+    pendingRisingEdge = None
+    sampleIndex = 0
+    for dat in _sortDataFiles(labjack_folder, fileNumberRange):
 
-    return event, indices
+        #
+        mat = readDataFile(dat)
+        if mat.shape[1] != NCHANNELS:
+            raise LabJackError(f'{mat.shape[1]} channels found in {dat} but {NCHANNELS} expected')
+        state = (mat[:, iev] > threshold).astype(np.int8)
+        del mat
+        if state.size == 0:
+            continue
+
+        # Compare the first sample against the last sample of the previous file
+        if previousState is None:
+            previousState = state[0]
+        deltaState = np.diff(state, prepend=previousState)
+        rising = np.flatnonzero(deltaState == 1) + sampleIndex
+        falling = np.flatnonzero(deltaState == -1) + sampleIndex
+        previousState = state[-1]
+        sampleIndex += state.size
+
+        #
+        if filterPulses:
+
+            # Pair each falling edge with the rising edge which precedes it
+            if pendingRisingEdge is not None:
+                rising = np.concatenate([[pendingRisingEdge], rising])
+            if falling.size != 0 and (rising.size == 0 or falling[0] < rising[0]):
+                falling = falling[1:] # No rising edge (the signal starts high)
+            pendingRisingEdge = rising[falling.size] if rising.size > falling.size else None
+            rising = rising[:falling.size]
+
+            #
+            rising, falling = _filterPulses(rising, falling, pulseWidthRange)
+
+        #
+        yield _selectEdges(rising, falling, edge)
+
+    return
 
 def extractBarcodeValues(signal, minimumBarcodeInterval=3, bitSize=0.03, labjackSamplingRate=1000):
     """
     """
 
     # TODO: parameterize the 20 value below
-    peaks, props = find_peaks(abs(np.diff(signal)), height=0.5)
+    peaks = np.flatnonzero(np.abs(np.diff(signal)) >= 0.5)
     longIntervalIndices = np.where(np.diff(peaks) >= minimumBarcodeInterval * labjackSamplingRate)[0]
-    pulseTrains = np.split(peaks, longIntervalIndices + 1)
-    pulseTrainOnsetIndices = np.array([
-        pulseTrain[0] + 20 for pulseTrain in pulseTrains
-    ])
+    if peaks.size == 0:
+        return np.array([], dtype=np.int64)
+    pulseTrainOnsetIndices = peaks[np.concatenate([[0], longIntervalIndices + 1])] + 20
 
-    #
-    values = list()
+    # Cut out the 32 bits of each barcode
     samplesPerBit = bitSize * labjackSamplingRate
-    for pulseTrainOnsetIndex in pulseTrainOnsetIndices:
-        pulseTrainOffsetIndex = int(pulseTrainOnsetIndex + samplesPerBit * 32)
-
-        #
-        if signal[pulseTrainOnsetIndex: pulseTrainOffsetIndex].size % 32 != 0:
+    pulseTrainOffsetIndices = (pulseTrainOnsetIndices + samplesPerBit * 32).astype(int)
+    windowSizes = np.clip(np.minimum(pulseTrainOffsetIndices, signal.size) - pulseTrainOnsetIndices, 0, None)
+    values = np.zeros(pulseTrainOnsetIndices.size, dtype=np.int64)
+    decoded = np.full(pulseTrainOnsetIndices.size, False)
+    for windowSize in np.unique(windowSizes):
+        if windowSize == 0 or windowSize % 32 != 0:
             continue
 
-        splits = np.split(signal[pulseTrainOnsetIndex: pulseTrainOffsetIndex], 32)
-        string = ''.join(
-            str(round(split.mean())) for split in splits[::-1]
-        )
-        value = int(string, 2)
-        values.append(value)
+        # Each bit is the rounded mean of the signal over its window (least significant bit first)
+        pulseTrainIndices = np.flatnonzero(windowSizes == windowSize)
+        windows = signal[pulseTrainOnsetIndices[pulseTrainIndices, None] + np.arange(windowSize)]
+        bits = np.rint(windows.reshape(-1, 32, windowSize // 32).mean(2)).astype(np.int64)
+        values[pulseTrainIndices] = bits @ (np.int64(1) << np.arange(32, dtype=np.int64))
+        decoded[pulseTrainIndices] = True
     
-    return np.array(values)
+    return values[decoded]
 
-def filterPulsesFromPhotologicDevice(signal, minimumPulseWidthInSeconds=0.14, samplingRate=1000):
+def _mergeRuns(values, lengths):
     """
+    Merge neighbouring runs which share the same value
     """
 
-    threshold = round(minimumPulseWidthInSeconds * samplingRate, 2)
-    mutated = np.copy(signal)
+    if values.size == 0:
+        return values, lengths
+    runStartIndices = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
 
-    #
-    while True:
+    return values[runStartIndices], np.add.reduceat(lengths, runStartIndices)
 
-        #
-        deltaState = np.diff(mutated)
-        edgeIndices = np.where(abs(deltaState) > 0.5)[0]
-        intervals = np.hstack([
-            edgeIndices[0: -1].reshape(-1, 1),
-            edgeIndices[1:   ].reshape(-1, 1)
-        ])
+def debounceDigitalSignal(signal, minimumRunLength, threshold=0.5):
+    """
+    Remove glitches from a digital signal using its run-length encoding
 
-        #
-        for firstEdgeIndex, secondEdgeIndex in intervals:
-            dt = secondEdgeIndex - firstEdgeIndex
-            if dt < threshold:
-                mutated[firstEdgeIndex + 1: secondEdgeIndex + 1] = 1
-                continue
+    Short low runs (gaps within a pulse) are filled in first and then short
+    high runs (spurious pulses) are removed; runs at the very beginning or end
+    of the signal are kept as is. Returns the cleaned signal and the indices of
+    the edges that survive (the last sample before each state transition, i.e.,
+    the same indices as np.where(np.abs(np.diff(cleaned)) > 0.5)[0])
+    """
 
-        #
-        break
-    
-    # Find intervals smaler than threshold then flatten them\
-    deltaState = np.diff(mutated)
-    edgeIndices = np.where(abs(deltaState) > 0.5)[0]
-    intervals = np.hstack([
-        edgeIndices[0: -1].reshape(-1, 1),
-        edgeIndices[1:   ].reshape(-1, 1)
-    ])
-    for firstEdgeIndex, secondEdgeIndex in intervals:
-        dt = secondEdgeIndex - firstEdgeIndex
-        if dt < threshold:
-            mutated[firstEdgeIndex + 1: secondEdgeIndex + 1] = 0
-            continue
+    signal = np.asarray(signal)
+    dtype = np.int16 if signal.dtype.kind == 'u' else signal.dtype # Signed output (see extractLabjackEvent)
+    if signal.size == 0:
+        return signal.astype(dtype), np.array([], dtype=int)
+
+    # Encode the signal as runs of the same state
+    state = signal > threshold
+    edgeIndices = np.flatnonzero(state[1:] != state[:-1])
+    values = state[np.concatenate([[0], edgeIndices + 1])]
+    lengths = np.diff(np.concatenate([[-1], edgeIndices, [signal.size - 1]]))
+
+    # Fill in the short gaps then remove the short pulses
+    for value in (False, True):
+        mask = np.logical_and(values == value, lengths < minimumRunLength)
+        mask[0], mask[-1] = False, False
+        values = np.where(mask, not value, values)
+        values, lengths = _mergeRuns(values, lengths)
 
     #
-    deltaState = np.diff(mutated)
-    edgeIndices = np.where(abs(deltaState) > 0.5)[0]
-    if np.all(np.diff(edgeIndices) > threshold):
-        return mutated
-    else:
-        raise Exception('ERROR: Pulse filtering failed')
+    cleaned = np.repeat(values, lengths).astype(dtype)
+    edgeIndices = np.cumsum(lengths[:-1]) - 1
+
+    return cleaned, edgeIndices
+
+def filterPulsesFromPhotologicDevice(signal, minimumPulseWidthInSeconds=0.14, samplingRate=1000):
+    """
+    Remove the glitches from the signal recorded by the photologic device
+    (see debounceDigitalSignal)
+    """
+
+    threshold = round(minimumPulseWidthInSeconds * samplingRate, 2)
+    cleaned, edgeIndices = debounceDigitalSignal(signal, threshold)
+
+    return cleaned
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter1d
+
+def _groupSpikes(spikeTimes, spikeClusters, clusters):
+    """
+    Sort spikes by cluster (and by time within each cluster)
+
+    Returns the grouped spike times, the index of the unit (into clusters)
+    that each grouped spike belongs to (-1 for spikes from other clusters),
+    and the order which groups the spikes
+    """
+
+    spikeOrder = np.lexsort((spikeTimes, spikeClusters))
+    groupedTimes = spikeTimes[spikeOrder]
+    groupedClusters = spikeClusters[spikeOrder]
+
+    #
+    unitIndices = np.searchsorted(clusters, groupedClusters)
+    unitIndices[unitIndices == clusters.size] = 0
+    unitIndices[clusters[unitIndices] != groupedClusters] = -1
+
+    return groupedTimes, unitIndices, spikeOrder
+
+def _countPerUnit(unitIndices, nUnits, weights=None):
+    """
+    Sum (or count) values per unit ignoring spikes from other clusters
+    """
+
+    mask = unitIndices >= 0
+    return np.bincount(
+        unitIndices[mask],
+        weights=None if weights is None else weights[mask],
+        minlength=nUnits
+    )
+
+def computeFiringRates(unitIndices, nUnits, recordingDuration):
+    """
+    Mean firing rate of each unit (in spikes per second)
+    """
+
+    return _countPerUnit(unitIndices, nUnits) / recordingDuration
+
+def computeIsiViolations(groupedTimes, unitIndices, nUnits, refractoryPeriod=0.0015):
+    """
+    Fraction of each unit's inter-spike intervals shorter than the refractory
+    period
+    """
+
+    intervals = np.diff(groupedTimes)
+    withinUnit = np.logical_and(unitIndices[1:] == unitIndices[:-1], unitIndices[1:] >= 0)
+    intervalUnitIndices = np.where(withinUnit, unitIndices[1:], -1)
+    nIntervals = _countPerUnit(intervalUnitIndices, nUnits)
+    nViolations = _countPerUnit(intervalUnitIndices, nUnits, weights=(intervals < refractoryPeriod).astype(float))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(nIntervals > 0, nViolations / nIntervals, np.nan)
+
+def computePresenceRatios(groupedTimes, unitIndices, nUnits, recordingBounds, nBins=100):
+    """
+    Fraction of equal-sized time bins (spanning the recording) in which each
+    unit fired at least one spike
+    """
+
+    start, stop = recordingBounds
+    binIndices = np.floor((groupedTimes - start) / (stop - start) * nBins).astype(np.int64)
+    binIndices = np.clip(binIndices, 0, nBins - 1)
+    mask = unitIndices >= 0
+    occupied = np.unique(unitIndices[mask].astype(np.int64) * nBins + binIndices[mask])
+
+    return np.bincount(occupied // nBins, minlength=nUnits) / nBins
+
+def computeAmplitudeCutoffs(amplitudes, unitIndices, nUnits, nBins=500, sigma=3):
+    """
+    Estimate the fraction of each unit's spikes which fall below the detection
+    threshold from the (smoothed) amplitude distribution (Hill et al., 2011)
+    """
+
+    mask = unitIndices >= 0
+    amplitudes, unitIndices = amplitudes[mask], unitIndices[mask]
+    spikeCounts = np.bincount(unitIndices, minlength=nUnits)
+
+    # Histogram every unit's amplitudes over its own range
+    lowerBounds = np.full(nUnits, np.inf)
+    upperBounds = np.full(nUnits, -np.inf)
+    np.minimum.at(lowerBounds, unitIndices, amplitudes)
+    np.maximum.at(upperBounds, unitIndices, amplitudes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        binWidths = (upperBounds - lowerBounds) / nBins
+        binIndices = np.floor((amplitudes - lowerBounds[unitIndices]) / binWidths[unitIndices])
+    binIndices = np.clip(np.nan_to_num(binIndices), 0, nBins - 1).astype(np.int64)
+    counts = np.bincount(unitIndices * nBins + binIndices, minlength=nUnits * nBins).reshape(nUnits, nBins)
+
+    # Smoothed probability density
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pdf = counts / (spikeCounts * binWidths).reshape(-1, 1)
+    pdf = gaussian_filter1d(pdf, sigma, axis=1)
+
+    # First bin past the peak where the density returns to that of the lowest bin
+    peakIndices = np.argmax(pdf, axis=1)
+    difference = np.abs(pdf - pdf[:, :1])
+    difference[np.arange(nBins) < peakIndices.reshape(-1, 1)] = np.inf
+    cutoffIndices = np.argmin(difference, axis=1)
+    tailSums = np.cumsum(pdf[:, ::-1], axis=1)[:, ::-1]
+    fractionMissing = tailSums[np.arange(nUnits), cutoffIndices] * binWidths
+    fractionMissing = np.minimum(fractionMissing, 0.5)
+
+    #
+    valid = np.logical_and(spikeCounts > 1, binWidths > 0)
+
+    return np.where(valid, fractionMissing, np.nan)
+
+def computeQualityMetrics(
+    spikeTimes,
+    spikeClusters,
+    clusters=None,
+    amplitudes=None,
+    refractoryPeriod=0.0015,
+    nPresenceBins=100,
+    recordingBounds=None,
+    ):
+    """
+    Compute quality metrics for every unit at once
+
+    keywords
+    --------
+    spikeTimes
+        Timestamps of every spike (in seconds)
+    spikeClusters
+        Cluster number of every spike
+    clusters
+        Cluster numbers of the units (defaults to every cluster with spikes)
+    amplitudes
+        Amplitude of every spike (amplitude cutoff is NaN if not specified)
+    refractoryPeriod
+        Inter-spike intervals shorter than this count as violations (in seconds)
+    nPresenceBins
+        Number of time bins used to compute the presence ratio
+    recordingBounds
+        Start and stop of the recording (defaults to the first and last spike)
+
+    returns
+    -------
+    table
+        Data frame indexed by cluster number
+    """
+
+    spikeTimes = np.asarray(spikeTimes).ravel()
+    spikeClusters = np.asarray(spikeClusters).ravel()
+    if clusters is None:
+        clusters = np.unique(spikeClusters)
+    clusters = np.asarray(clusters).ravel()
+    nUnits = clusters.size
+
+    # Metrics are computed on sorted cluster numbers, then put back in order
+    clusterOrder = np.argsort(clusters, kind='stable')
+    sortedClusters = clusters[clusterOrder]
+    groupedTimes, unitIndices, spikeOrder = _groupSpikes(spikeTimes, spikeClusters, sortedClusters)
+
+    #
+    if recordingBounds is None:
+        recordingBounds = (spikeTimes.min(), spikeTimes.max()) if spikeTimes.size else (0, 1)
+    recordingDuration = recordingBounds[1] - recordingBounds[0]
+
+    #
+    columns = {
+        'spikeCount': _countPerUnit(unitIndices, nUnits).astype(np.int64),
+        'firingRate': computeFiringRates(unitIndices, nUnits, recordingDuration),
+        'isiViolations': computeIsiViolations(groupedTimes, unitIndices, nUnits, refractoryPeriod),
+        'presenceRatio': computePresenceRatios(groupedTimes, unitIndices, nUnits, recordingBounds, nPresenceBins),
+    }
+    if amplitudes is None:
+        columns['amplitudeCutoff'] = np.full(nUnits, np.nan)
+    else:
+        amplitudes = np.asarray(amplitudes).ravel()[spikeOrder]
+        columns['amplitudeCutoff'] = computeAmplitudeCutoffs(amplitudes, unitIndices, nUnits)
+
+    #
+    inverseOrder = np.empty(nUnits, dtype=np.int64)
+    inverseOrder[clusterOrder] = np.arange(nUnits)
+    table = pd.DataFrame(
+        {key: value[inverseOrder] for key, value in columns.items()},
+        index=pd.Index(clusters, name='cluster')
+    )
+
+    return table
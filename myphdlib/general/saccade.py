@@ -224,10 +224,9 @@ def filterEyePosition(sessionObject, t=25):
     # Filter
     eyePositionDecomposed = sessionObject.load('eyePositionDecomposed')
     eyePositionFiltered = np.full_like(eyePositionDecomposed, np.nan)
-    for columnIndex in range(eyePositionDecomposed.shape[1]):
-        if np.isnan(eyePositionDecomposed[:, columnIndex]).all():
-            continue
-        eyePositionFiltered[:, columnIndex] = smooth(eyePositionDecomposed[:, columnIndex], smoothingWindowSize)
+    columnMask = np.invert(np.isnan(eyePositionDecomposed).all(0))
+    if columnMask.any():
+        eyePositionFiltered[:, columnMask] = smooth(eyePositionDecomposed[:, columnMask], smoothingWindowSize, axis=0)
 
     # Save filtered eye position data
     saveSessionData(sessionObject, 'eyePositionFiltered', eyePositionFiltered)
@@ -612,7 +611,8 @@ def computeSaccadeTimestamps(session):
     Compute the saccade onset timestamps
     """
 
-    if 'timestampGeneratorParameters' not in session.keys:
+    keys = session.keys
+    if 'timestampGenerator' not in keys and 'timestampGeneratorParameters' not in keys:
         raise Exception(f'Session for {session.animal} on {session.date} has no timestamp generator')
 
     #
@@ -634,7 +634,7 @@ def computeSaccadeTimestamps(session):
     )
 
     #
-    params = DotDict(session.load('timestampGeneratorParameters'))
+    timestampGenerator = session.timestampGenerator
 
     #
     saccadeClassificationResults = session.load('saccadeClassificationResults')
@@ -645,7 +645,7 @@ def computeSaccadeTimestamps(session):
             
             #
             timestamps = np.around(
-                np.interp(sampleIndices, params.xp, params.fp) * params.m + params.b,
+                timestampGenerator.convert(sampleIndices),
                 3
             )
             saccadeOnsetTimestamps[eye][direction] = timestamps
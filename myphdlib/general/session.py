@@ -4,6 +4,8 @@ import string
 import pickle
 import pathlib as pl
 from myphdlib.general.ephys import SpikeSortingResults
+from myphdlib.general.sync import TimestampGenerator, LegacyTimestampGenerator
+from myphdlib.general.storage import DirectoryStore
 
 class SessionBase():
     """
@@ -19,6 +21,7 @@ class SessionBase():
 
         # Private attributes
         self._rez = None
+        self._timestampGenerator = None
 
         # Define file paths
         if resolve:
@@ -26,50 +29,17 @@ class SessionBase():
 
         return
 
-    def load(self, name):
+    def load(self, name, mmap=False):
         """
         """
 
-        if self.outputFilePath.exists() == False:
-            raise Exception('Could not locate output file')
-
-        with open(self.outputFilePath, 'rb') as stream:
-            try:
-                dataContainer = pickle.load(stream)
-            except EOFError as error:
-                raise Exception(f'Ouptut file is corrupted') from None
-
-        if name not in dataContainer.keys():
-            raise Exception(f'Invalid data key: {name}')
-        else:
-            return dataContainer[name]
+        return loadSessionData(self, name, mmap)
 
     def save(self, name, data, createOutputFile=False):
         """
         """
 
-        # TODO: Make this fail safe such that a R/W error doesn't corrupt the output files
-
-        #
-        if self.outputFilePath.exists() == False:
-            if createOutputFile:
-                with open(str(self.outputFilePath), 'wb') as stream:
-                    pass
-            else:
-                raise Exception('Could not locate output file')
-
-        #
-        with open(str(self.outputFilePath), 'rb') as stream:
-            try:
-                dataContainer = pickle.load(stream)
-            except EOFError:
-                dataContainer = dict()
-        self.outputFilePath.unlink() # TODO: Wait to delete the output file until it passes a check
-
-        #
-        dataContainer.update({name: data})
-        with open(str(self.outputFilePath), 'wb') as stream:
-            pickle.dump(dataContainer, stream)
+        saveSessionData(self, name, data, createOutputFile)
 
         return
 
@@ -85,6 +55,12 @@ class SessionBase():
         """
         """
 
+        #
+        store = _openOutputStore(self.outputFilePath)
+        if store is not None:
+            store.delete(name)
+            return
+
         #
         if self.outputFilePath.exists() == False:
             raise Exception('Could not locate output file')
@@ -141,6 +117,10 @@ class SessionBase():
         """
         """
 
+        store = _openOutputStore(self.outputFilePath)
+        if store is not None:
+            return store.keys()
+
         with open(str(self.outputFilePath), 'rb') as stream:
             try:
                 dataContainer = pickle.load(stream)
@@ -184,6 +164,24 @@ class SessionBase():
 
         return result
 
+    @property
+    def timestampGenerator(self):
+        """
+        Maps labjack sample indices onto the Neuropixels clock (loaded once)
+        """
+
+        if self._timestampGenerator is None:
+
+            # Sessions synchronized before the generator was introduced only
+            # have the parameters of the original linear mapping
+            keys = self.keys
+            if 'timestampGenerator' not in keys and 'timestampGeneratorParameters' in keys:
+                self._timestampGenerator = LegacyTimestampGenerator(self.load('timestampGeneratorParameters'))
+            else:
+                self._timestampGenerator = TimestampGenerator.fromDict(self.load('timestampGenerator'))
+
+        return self._timestampGenerator
+
     @property
     def rez(self):
         """
@@ -194,40 +192,67 @@ class SessionBase():
 
         return self._rez
 
-def saveSessionData(sessionObject, name, data, createOutputFile=True):
+def _openOutputStore(outputFilePath, create=False):
     """
+    Open the directory store which holds a session's data
+
+    Returns None for sessions which still keep their data in a single pickled
+    output file (see myphdlib.general.storage.migrateOutputFile) and for
+    sessions without any data unless create is True
     """
 
-    #
-    if sessionObject.outputFilePath.exists() == False:
-        if createOutputFile:
-            with open(str(sessionObject.outputFilePath), 'wb') as stream:
-                pass
-        else:
-            raise Exception('Could not locate output file')
+    store = DirectoryStore.fromOutputFile(outputFilePath)
+    if store.exists():
+        return store
+    if pl.Path(outputFilePath).exists():
+        return
+    if create:
+        store.initialize()
+        return store
 
-    #
-    with open(str(sessionObject.outputFilePath), 'rb') as stream:
-        try:
-            dataContainer = pickle.load(stream)
-        except EOFError:
-            dataContainer = dict()
-    sessionObject.outputFilePath.unlink() # TODO: Wait to delete the output file until it passes a check
+    return
 
-    #
-    try:
+def saveSessionData(sessionObject, name, data, createOutputFile=True):
+    """
+    """
+
+    # Only the entry being saved is written
+    store = _openOutputStore(sessionObject.outputFilePath, create=createOutputFile)
+    if store is not None:
+        store.write(name, data)
+
+    # Sessions which have not been migrated keep using the pickled output file
+    elif sessionObject.outputFilePath.exists():
+        with open(str(sessionObject.outputFilePath), 'rb') as stream:
+            try:
+                dataContainer = pickle.load(stream)
+            except EOFError:
+                dataContainer = dict()
+        sessionObject.outputFilePath.unlink() # TODO: Wait to delete the output file until it passes a check
         dataContainer.update({name: data})
         with open(str(sessionObject.outputFilePath), 'wb') as stream:
             pickle.dump(dataContainer, stream)
-    except:
-        import pdb; pdb.set_trace() # TODO: Remove this
+
+    else:
+        raise Exception('Could not locate output file')
+
+    # Drop the cached timestamp generator if it was replaced
+    if name in ('timestampGenerator', 'timestampGeneratorParameters') and hasattr(sessionObject, '_timestampGenerator'):
+        sessionObject._timestampGenerator = None
 
     return
 
-def loadSessionData(sessionObject, name):
+def loadSessionData(sessionObject, name, mmap=False):
     """
+    Load one entry (arrays from migrated sessions can be memory-mapped)
     """
 
+    #
+    store = _openOutputStore(sessionObject.outputFilePath)
+    if store is not None:
+        return store.read(name, mmap)
+
+    #
     if sessionObject.outputFilePath.exists() == False:
         raise Exception('Could not locate output file')
 
@@ -0,0 +1,598 @@
+import os
+import re
+import json
+import sys
+import time
+import uuid
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import pathlib as pl
+
+def _applyDefaultFileMode(filePath):
+    """
+    Give a temporary file the permissions of a regularly created file
+    (tempfile.mkstemp creates files that only the owner can read)
+    """
+
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(filePath, 0o666 & ~umask)
+
+    return
+
+def _replaceFile(filePath, function, fsync=False):
+    """
+    Write a file next to its destination and then move it into place so
+    that an interrupted write never leaves a partial file behind (temporary
+    files are named <stem>.<random>.tmp)
+    """
+
+    filePath = pl.Path(filePath)
+    descriptor, temporaryFilePath = tempfile.mkstemp(dir=filePath.parent, prefix=f'{filePath.stem}.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as stream:
+            function(stream)
+            if fsync:
+                stream.flush()
+                os.fsync(stream.fileno())
+        _applyDefaultFileMode(temporaryFilePath)
+        os.replace(temporaryFilePath, filePath)
+    except BaseException:
+        if os.path.exists(temporaryFilePath):
+            os.remove(temporaryFilePath)
+        raise
+
+    return
+
+class _IndexFile():
+    """
+    Index of a session output store which is only re-read when the file
+    changed on disk and is always replaced atomically
+    """
+
+    def __init__(self, filePath, load, dump, fsync=False):
+        """
+        """
+
+        self.filePath = pl.Path(filePath)
+        self.load = load
+        self.dump = dump
+        self.fsync = fsync
+        self._index = None
+        self._signature = None
+
+        return
+
+    def _stat(self):
+        stat = os.stat(self.filePath)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def read(self):
+        """
+        Load the index (or return the copy in memory if the file is unchanged)
+        """
+
+        signature = self._stat()
+        if self._index is None or signature != self._signature:
+            with open(self.filePath, 'rb') as stream:
+                self._index = self.load(stream)
+            self._signature = signature
+
+        return self._index
+
+    def write(self, index):
+        """
+        Atomically replace the index file
+        """
+
+        _replaceFile(self.filePath, lambda stream: self.dump(index, stream), self.fsync)
+        self._index = index
+        self._signature = self._stat()
+
+        return
+
+class DirectoryStore():
+    """
+    Session output storage where every key is kept in its own file
+
+    Arrays with a fixed-size data type are saved as .npy files (which can be
+    memory-mapped) and everything else is pickled. An index file lists the
+    keys and the file which holds each one, so reading (or writing) one key
+    never touches the others
+    """
+
+    indexFilename = 'index.json'
+
+    def __init__(self, storeFolder):
+        """
+        """
+
+        self.storeFolderPath = pl.Path(storeFolder)
+        self._indexFile = _IndexFile(
+            self.indexFilePath,
+            load=json.load,
+            dump=lambda index, stream: stream.write(json.dumps(index, indent=4).encode())
+        )
+
+        return
+
+    @classmethod
+    def fromOutputFile(cls, outputFilePath):
+        """
+        Store which replaces a pickled output file (e.g., output.pickle is
+        replaced by the output.store folder next to it)
+        """
+
+        outputFilePath = pl.Path(outputFilePath)
+        return cls(outputFilePath.with_suffix('.store'))
+
+    def exists(self):
+        return self.storeFolderPath.joinpath(self.indexFilename).exists()
+
+    def initialize(self):
+        """
+        Create the store folder and an empty index
+        """
+
+        self.storeFolderPath.mkdir(parents=True, exist_ok=True)
+        if self.exists() == False:
+            self._writeIndex(dict())
+
+        return
+
+    @property
+    def indexFilePath(self):
+        return self.storeFolderPath.joinpath(self.indexFilename)
+
+    def _readIndex(self):
+        if self.exists() == False:
+            raise Exception('Could not locate output store')
+        return self._indexFile.read()
+
+    def _writeIndex(self, index):
+        self._indexFile.write(index)
+        return
+
+    def _filenameFromKey(self, key, extension):
+        """
+        Derive a file name from a key (keys with unusual characters are escaped)
+        """
+
+        if re.fullmatch(r'[A-Za-z0-9_\-]+', key):
+            stem = key
+        else:
+            stem = 'key-' + key.encode().hex()
+
+        return f'{stem}{extension}'
+
+    def keys(self):
+        """
+        Keys in the store (only the index is read)
+        """
+
+        return list(self._readIndex().keys())
+
+    def __contains__(self, key):
+        return key in self._readIndex()
+
+    def write(self, key, value):
+        """
+        Save a single key
+        """
+
+        if self.exists() == False:
+            self.initialize()
+
+        # Plain arrays (and memory-maps) go into .npy files and everything else,
+        # including subclasses such as masked arrays, is pickled
+        if type(value) in (np.ndarray, np.memmap) and value.dtype.hasobject == False:
+            filename = self._filenameFromKey(key, '.npy')
+            _replaceFile(self.storeFolderPath.joinpath(filename), lambda stream: np.save(stream, np.asarray(value), allow_pickle=False))
+        else:
+            filename = self._filenameFromKey(key, '.pkl')
+            _replaceFile(self.storeFolderPath.joinpath(filename), lambda stream: pickle.dump(value, stream))
+
+        # Update the index last and remove the previous file (if it changed)
+        index = dict(self._readIndex())
+        previousFilename = index.get(key)
+        index[key] = filename
+        self._writeIndex(index)
+        if previousFilename is not None and previousFilename != filename:
+            self.storeFolderPath.joinpath(previousFilename).unlink(missing_ok=True)
+
+        return
+
+    def read(self, key, mmap=False):
+        """
+        Load a single key (arrays can be memory-mapped copy-on-write, so
+        modifying them never changes the file)
+        """
+
+        index = self._readIndex()
+        if key not in index:
+            raise Exception(f'Invalid data key: {key}')
+
+        filePath = self.storeFolderPath.joinpath(index[key])
+        if filePath.suffix == '.npy':
+            return np.load(filePath, mmap_mode='c' if mmap else None, allow_pickle=False)
+        else:
+            with open(filePath, 'rb') as stream:
+                return pickle.load(stream)
+
+    def delete(self, key):
+        """
+        Remove a single key
+        """
+
+        index = dict(self._readIndex())
+        if key not in index:
+            raise Exception(f'Invalid data key: {key}')
+        filename = index.pop(key)
+        self._writeIndex(index)
+        self.storeFolderPath.joinpath(filename).unlink(missing_ok=True)
+
+        return
+
+class OutputLog():
+    """
+    Session output storage made of an append-only record log and an index
+
+    Every write appends one pickled record to the log and then atomically
+    replaces the (small) index which maps each key to the location of its
+    latest record, so writes only cost as much as the new data and a crash
+    can at worst leave an unreferenced record behind. Deleted and overwritten
+    records are reclaimed by compaction (see compactOutputLog)
+    """
+
+    def __init__(self, indexFilePath):
+        """
+        """
+
+        self.indexFilePath = pl.Path(indexFilePath)
+        self._indexFile = _IndexFile(
+            self.indexFilePath,
+            load=pickle.load,
+            dump=pickle.dump,
+            fsync=True
+        )
+
+        return
+
+    @property
+    def folderPath(self):
+        return self.indexFilePath.parent
+
+    def exists(self):
+        return self.indexFilePath.exists()
+
+    def _readIndex(self):
+        if self.exists() == False:
+            raise Exception('Could not locate output log')
+        return self._indexFile.read()
+
+    def _writeIndex(self, index):
+        self._indexFile.write(index)
+        return
+
+    def _newLogFilename(self):
+        return f'{self.indexFilePath.stem}.{uuid.uuid4().hex[:8]}.log'
+
+    def initialize(self):
+        """
+        Create an empty log and index
+        """
+
+        if self.exists() == False:
+            self.folderPath.mkdir(parents=True, exist_ok=True)
+            self._writeIndex({'log': self._newLogFilename(), 'records': dict()})
+
+        return
+
+    @property
+    def logFilePath(self):
+        return self.folderPath.joinpath(self._readIndex()['log'])
+
+    def keys(self):
+        """
+        Keys in the log (only the index is read)
+        """
+
+        return list(self._readIndex()['records'].keys())
+
+    def __contains__(self, key):
+        return key in self._readIndex()['records']
+
+    def locate(self, key):
+        """
+        Return the log file name, offset and length of a key's latest record
+        """
+
+        index = self._readIndex()
+        if key not in index['records']:
+            raise Exception(f'Invalid key: {key}')
+        offset, length = index['records'][key]
+
+        return index['log'], offset, length
+
+    def read(self, key):
+        """
+        Load a single key
+        """
+
+        logFilename, offset, length = self.locate(key)
+        with open(self.folderPath.joinpath(logFilename), 'rb') as stream:
+            stream.seek(offset)
+            return pickle.loads(stream.read(length))
+
+    def _append(self, records):
+        """
+        Append serialized records to the log and return their locations
+        """
+
+        locations = list()
+        with open(self.logFilePath, 'ab') as stream:
+            stream.seek(0, os.SEEK_END)
+            for record in records:
+                locations.append((stream.tell(), len(record)))
+                stream.write(record)
+            stream.flush()
+            os.fsync(stream.fileno())
+
+        return locations
+
+    def write(self, key, obj):
+        """
+        Save a single key
+        """
+
+        self.initialize()
+        self.update({key: obj})
+
+        return
+
+    def update(self, container):
+        """
+        Save several keys with a single index update
+        """
+
+        self.initialize()
+        records = [pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL) for value in container.values()]
+        locations = self._append(records)
+
+        #
+        index = self._readIndex()
+        index = {'log': index['log'], 'records': dict(index['records'])}
+        for key, location in zip(container.keys(), locations):
+            index['records'][key] = location
+        self._writeIndex(index)
+
+        return
+
+    def delete(self, key):
+        """
+        Remove a single key (its record stays in the log until compaction)
+        """
+
+        index = self._readIndex()
+        if key not in index['records']:
+            raise Exception(f'Invalid key: {key}')
+        index = {'log': index['log'], 'records': dict(index['records'])}
+        del index['records'][key]
+        self._writeIndex(index)
+
+        return
+
+    def compact(self):
+        """
+        Rewrite the log with only the latest record of each key
+
+        The live records are copied into a new log file, the index is switched
+        over to it, and only then is the old log deleted
+        """
+
+        index = self._readIndex()
+        oldLogFilePath = self.folderPath.joinpath(index['log'])
+        newLogFilename = self._newLogFilename()
+
+        #
+        records = dict()
+        with open(oldLogFilePath, 'rb') as source, open(self.folderPath.joinpath(newLogFilename), 'wb') as destination:
+            for key, (offset, length) in index['records'].items():
+                source.seek(offset)
+                records[key] = (destination.tell(), length)
+                destination.write(source.read(length))
+            destination.flush()
+            os.fsync(destination.fileno())
+
+        #
+        self._writeIndex({'log': newLogFilename, 'records': records})
+        oldLogFilePath.unlink(missing_ok=True)
+
+        return
+
+def compactOutputLog(indexFilePath):
+    """
+    Reclaim the space used by deleted and overwritten records in an output log
+    (run while nothing else is writing to the session)
+
+    returns
+    -------
+    sizes
+        Size of the log before and after compaction (in bytes)
+    """
+
+    log = OutputLog(indexFilePath)
+    if log.exists() == False:
+        raise Exception('Could not locate output log')
+
+    #
+    sizeBefore = log.logFilePath.stat().st_size
+    log.compact()
+    sizeAfter = log.logFilePath.stat().st_size
+
+    # Remove files left behind by interrupted writes (or compactions)
+    stem = log.indexFilePath.stem
+    for filePath in list(log.folderPath.glob(f'{stem}.*.tmp')) + list(log.folderPath.glob(f'{stem}.*.log')):
+        if filePath != log.logFilePath:
+            filePath.unlink(missing_ok=True)
+
+    return sizeBefore, sizeAfter
+
+def migrateOutputFile(outputFilePath, removeOutputFile=False):
+    """
+    Copy every key in a pickled output file into a directory store
+
+    keywords
+    --------
+    outputFilePath
+        Path to the output file (e.g., output.pickle)
+    removeOutputFile
+        Delete the output file once every key has been copied
+
+    returns
+    -------
+    store
+        Directory store which now holds the session's data
+    """
+
+    outputFilePath = pl.Path(outputFilePath)
+    if outputFilePath.exists() == False:
+        raise Exception('Could not locate output file')
+
+    #
+    with open(outputFilePath, 'rb') as stream:
+        try:
+            container = pickle.load(stream)
+        except EOFError:
+            container = dict()
+
+    #
+    store = DirectoryStore.fromOutputFile(outputFilePath)
+    store.initialize()
+    for key, value in container.items():
+        store.write(key, value)
+
+    #
+    if removeOutputFile:
+        outputFilePath.unlink()
+
+    return store
+
+def migrateOutputLog(outputFilePath, indexFilePath=None, removeOutputFile=False):
+    """
+    Copy every key in a pickled output file into a new output log
+
+    keywords
+    --------
+    outputFilePath
+        Path to the output file (e.g., output.pkl)
+    indexFilePath
+        Path to the log's index (defaults to output.index next to the output file)
+    removeOutputFile
+        Delete the output file once every key has been copied
+
+    returns
+    -------
+    log
+        Output log which now holds the session's data
+    """
+
+    outputFilePath = pl.Path(outputFilePath)
+    if outputFilePath.exists() == False:
+        raise Exception('Could not locate output file')
+    if indexFilePath is None:
+        indexFilePath = outputFilePath.parent.joinpath('output.index')
+    log = OutputLog(indexFilePath)
+    if log.exists():
+        raise Exception('Output log already exists')
+
+    #
+    with open(outputFilePath, 'rb') as stream:
+        try:
+            container = pickle.load(stream)
+        except EOFError:
+            container = dict()
+
+    #
+    log.update(container)
+
+    #
+    if removeOutputFile:
+        outputFilePath.unlink()
+
+    return log
+
+def benchmarkStorage(sessionSizes=(10, 100, 1000), nRepeats=10, workingFolder=None):
+    """
+    Compare how long it takes to read one small key from a pickled output file
+    and from a directory store as the rest of the session grows
+
+    keywords
+    --------
+    sessionSizes
+        Size of the large array saved next to the small key (in MB)
+    nRepeats
+        Number of reads to average over
+    workingFolder
+        Folder to write the test sessions to (defaults to a temporary folder)
+
+    returns
+    -------
+    results
+        List of (size in MB, pickle read time, store read time) tuples (in s)
+    """
+
+    workingFolderPath = pl.Path(tempfile.mkdtemp() if workingFolder is None else workingFolder)
+    results = list()
+    try:
+        for sessionSize in sessionSizes:
+
+            #
+            container = {
+                'labjackDataMatrix': np.random.random(int(sessionSize * 1e6 / 8)),
+                'fps': 200
+            }
+            outputFilePath = workingFolderPath.joinpath(f'output{sessionSize}MB.pickle')
+            with open(outputFilePath, 'wb') as stream:
+                pickle.dump(container, stream)
+            store = migrateOutputFile(outputFilePath)
+
+            #
+            t1 = time.perf_counter()
+            for iRepeat in range(nRepeats):
+                with open(outputFilePath, 'rb') as stream:
+                    pickle.load(stream)['fps']
+            t2 = time.perf_counter()
+            for iRepeat in range(nRepeats):
+                DirectoryStore.fromOutputFile(outputFilePath).read('fps')
+            t3 = time.perf_counter()
+
+            #
+            results.append((sessionSize, (t2 - t1) / nRepeats, (t3 - t2) / nRepeats))
+            print(f'INFO: {sessionSize} MB session, {results[-1][1] * 1000:.3f} ms (pickle) vs. {results[-1][2] * 1000:.3f} ms (store)')
+
+    finally:
+        if workingFolder is None:
+            shutil.rmtree(workingFolderPath, ignore_errors=True)
+
+    return results
+
+if __name__ == '__main__':
+
+    # Offline maintenance, e.g., python -m myphdlib.general.storage compact <session>/output.index
+    # (migrate creates a directory store, migrate-log an output log, from a pickled output file)
+    command, paths = sys.argv[1], sys.argv[2:]
+    for path in paths:
+        if command == 'compact':
+            sizeBefore, sizeAfter = compactOutputLog(path)
+            print(f'INFO: Compacted {path} from {sizeBefore} to {sizeAfter} bytes')
+        elif command == 'migrate':
+            migrateOutputFile(path)
+            print(f'INFO: Migrated {path}')
+        elif command == 'migrate-log':
+            migrateOutputLog(path)
+            print(f'INFO: Migrated {path}')
+        else:
+            raise Exception(f'Invalid command: {command}')
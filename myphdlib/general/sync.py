@@ -3,13 +3,42 @@ import numpy as np
 samplingRateLabjack = 1000
 samplingRateNeuropoixels = 30000
 
+def _findPulseTrainBounds(stateTransitionIndices, minimumInterval, chunkSize=1000000):
+    """
+    Split the state transitions wherever the interval between them is long,
+    one chunk at a time so that memory-mapped arrays are only read piecewise
+
+    Returns an N pulse trains x 2 array with the start and stop (exclusive)
+    of each train
+    """
+
+    nStateTransitions = stateTransitionIndices.shape[0]
+    splitIndices = [np.array([0])]
+    for start in range(0, nStateTransitions - 1, chunkSize):
+        chunk = np.asarray(stateTransitionIndices[start: start + chunkSize + 1])
+        splitIndices.append(np.flatnonzero(np.diff(chunk) >= minimumInterval) + start + 1)
+    splitIndices.append(np.array([nStateTransitions]))
+    splitIndices = np.concatenate(splitIndices)
+    if nStateTransitions == 0:
+        return np.empty((0, 2), dtype=int)
+
+    return np.column_stack([splitIndices[:-1], splitIndices[1:]])
+
 def extractPulseTrains(
     variableInput,
     device='lj',
     maximumWrapperPulseDuration=0.011,
     minimumBarcodeInterval=3,
+    compact=False,
+    chunkSize=1000000,
     ):
     """
+    Find the complete barcode pulse trains
+
+    If compact is True the pulse trains are returned as a tuple of the state
+    transition indices and an N pulse trains x 2 array with the start and stop
+    of each train instead of a list of arrays (for Neuropixels the indices are
+    the memory-mapped timestamps file, so nothing is read that isn't needed)
     """
 
     #
@@ -18,17 +47,12 @@ def extractPulseTrains(
 
     # Identify pulse trains recorded by Neuropixels
     if device in ('np', 'neuropixels', 'Neuropixels', 'NeuroPixels'):
-        stateTransitionIndices = np.load(variableInput)
+        stateTransitionIndices = np.load(variableInput, mmap_mode='r')
         samplingRate = samplingRateNeuropoixels
 
     # Identify pulse trains recorded by labjack
     elif device in ('lj', 'labjack', 'Labjack', 'LabJack'):
-        stateTransitionIndices = np.where(
-            np.logical_or(
-                np.diff(variableInput) > +0.5,
-                np.diff(variableInput) < -0.5
-            )
-        )[0]
+        stateTransitionIndices = np.flatnonzero(np.abs(np.diff(variableInput)) > 0.5)
         samplingRate = samplingRateLabjack
 
     #
@@ -36,35 +60,41 @@ def extractPulseTrains(
         raise Exception(f'Invalid device: {device}')
 
     # Parse individual barcode pulse trains
-    longIntervalIndices = np.where(
-        np.diff(stateTransitionIndices) >= minimumBarcodeInterval * samplingRate
-    )[0]
-    pulseTrains = np.split(stateTransitionIndices, longIntervalIndices + 1)
+    pulseTrainBounds = _findPulseTrainBounds(
+        stateTransitionIndices,
+        minimumBarcodeInterval * samplingRate,
+        chunkSize
+    )
+
+    # Need at least 1 pulse on each side for the wrapper
+    pulseTrainBounds = pulseTrainBounds[pulseTrainBounds[:, 1] - pulseTrainBounds[:, 0] >= 4]
 
-    # Filter out incomplete pulse trains
+    # Wrapper pulses should be smaller than the encoding pulses
     pulseDurationThreshold = round(maximumWrapperPulseDuration * samplingRate)
-    pulseTrainsFiltered = list()
-    for pulseTrain in pulseTrains:
-
-        # Need at least 1 pulse on each side for the wrapper
-        if pulseTrain.size < 4:
-            continue
-
-        # Wrapper pulses should be smaller than the encoding pulses
-        firstPulseDuration = pulseTrain[1] - pulseTrain[0]
-        finalPulseDuration = pulseTrain[-1] - pulseTrain[-2]
-        if firstPulseDuration > pulseDurationThreshold:
-            continue
-        elif finalPulseDuration > pulseDurationThreshold:
-            continue
-        
-        # Complete pulses
-        pulseTrainsFiltered.append(pulseTrain)
+    firstPulseDurations = \
+        np.asarray(stateTransitionIndices[pulseTrainBounds[:, 0] + 1]) - \
+        np.asarray(stateTransitionIndices[pulseTrainBounds[:, 0]])
+    finalPulseDurations = \
+        np.asarray(stateTransitionIndices[pulseTrainBounds[:, 1] - 1]) - \
+        np.asarray(stateTransitionIndices[pulseTrainBounds[:, 1] - 2])
+    pulseTrainBounds = pulseTrainBounds[np.logical_and(
+        firstPulseDurations <= pulseDurationThreshold,
+        finalPulseDurations <= pulseDurationThreshold
+    )]
+
+    #
+    if compact:
+        return stateTransitionIndices, pulseTrainBounds
+    pulseTrainsFiltered = [
+        np.array(stateTransitionIndices[start: stop]) for start, stop in pulseTrainBounds
+    ]
 
     return pulseTrainsFiltered
 
 def decodePulseTrains(pulseTrains, device='lj', barcodeBitSize=0.03, wrapperBitSize=0.01):
     """
+    Decode the value of each barcode (pulseTrains can be a list of arrays or
+    the compact representation returned by extractPulseTrains)
     """
 
     global samplingRateLabjack
@@ -77,59 +107,324 @@ def decodePulseTrains(pulseTrains, device='lj', barcodeBitSize=0.03, wrapperBitS
     else:
         raise Exception(f'Invalid device: {device}')
 
-    values, indices = list(), list()
-
-    offset = 0
-    for pulseTrain in pulseTrains:
-
-        # 
-        wrapperFallingEdge = pulseTrain[1]
-        wrapperRisingEdge = pulseTrain[-2]
-        barcodeLeftEdge = wrapperFallingEdge + round(wrapperBitSize * samplingRate)
-        barcodeRightEdge = wrapperRisingEdge - round(wrapperBitSize * samplingRate)
-        
-        # Determine the state at the beginning and end of the data window
-        firstStateTransition = pulseTrain[2]
-        if (firstStateTransition - barcodeLeftEdge) / samplingRate < 0.001:
-            initialSignalState = currentSignalState = True
-        else:
-            initialSignalState = currentSignalState = False
-        finalStateTransition = pulseTrain[-3]
-        if (barcodeRightEdge - finalStateTransition) / samplingRate < 0.001:
-            finalSignalState = True
-        else:
-            finalSignalState = False
-
-        # Determine what indices to use for computing time intervals between state transitions
-        if initialSignalState == True and finalSignalState == True:
-            iterable = pulseTrain[2: -2]
-        elif initialSignalState == True and finalSignalState == False:
-            iterable = np.concatenate([pulseTrain[2:-2], np.array([barcodeRightEdge])])
-        elif initialSignalState == False and finalSignalState == False:
-            iterable = np.concatenate([np.array([barcodeLeftEdge]), pulseTrain[2:-2], np.array([barcodeRightEdge])])
-        elif initialSignalState == False and finalSignalState == True:
-            iterable = np.concatenate([np.array([barcodeLeftEdge]), pulseTrain[2:-2]])
-        
-        # Determine how many bits are stored in each time interval and keep track of the signal state
-        bitList = list()
-        for nSamples in np.diff(iterable):
-            nBits = int(round(nSamples / (barcodeBitSize * samplingRate)))
-            for iBit in range(nBits):
-                bitList.append(1 if currentSignalState else 0)
-            currentSignalState = not currentSignalState
-
-        # Decode the strings of bits
-        bitString = ''.join(map(str, bitList[::-1]))
-        if len(bitString) != 32:
-            raise Exception(f'More or less that 32 bits decoded')
-        value = int(bitString, 2) + offset
-
-        # 32-bit integer overflow
-        if value == 2 ** 32 - 1:
-            offset = 2 ** 32
+    # Flatten the pulse trains and keep track of each sample's position within its train
+    if isinstance(pulseTrains, tuple):
+        stateTransitionIndices, pulseTrainBounds = pulseTrains
+        pulseTrainLengths = pulseTrainBounds[:, 1] - pulseTrainBounds[:, 0]
+    else:
+        pulseTrainLengths = np.array([pulseTrain.size for pulseTrain in pulseTrains], dtype=int)
+    nPulseTrains = pulseTrainLengths.size
+    if nPulseTrains == 0:
+        return np.array([]), np.array([])
+    pulseTrainStarts = np.concatenate([[0], np.cumsum(pulseTrainLengths)[:-1]])
+    pulseTrainIndices = np.repeat(np.arange(nPulseTrains), pulseTrainLengths)
+    if isinstance(pulseTrains, tuple):
+        offsets = np.repeat(pulseTrainBounds[:, 0] - pulseTrainStarts, pulseTrainLengths)
+        stateTransitionIndices = np.asarray(stateTransitionIndices[offsets + np.arange(offsets.size)])
+    else:
+        stateTransitionIndices = np.concatenate(pulseTrains)
+    positions = np.arange(stateTransitionIndices.size) - pulseTrainStarts[pulseTrainIndices]
+    lastPositions = pulseTrainLengths[pulseTrainIndices] - 1
+
+    # The edges of the barcode sit just inside the wrapper pulses
+    wrapperBitSizeInSamples = round(wrapperBitSize * samplingRate)
+    barcodeLeftEdges = stateTransitionIndices[pulseTrainStarts + 1] + wrapperBitSizeInSamples
+    barcodeRightEdges = stateTransitionIndices[pulseTrainStarts + pulseTrainLengths - 2] - wrapperBitSizeInSamples
+
+    # Determine the state at the beginning and end of the data window
+    firstStateTransitions = stateTransitionIndices[pulseTrainStarts + 2]
+    finalStateTransitions = stateTransitionIndices[pulseTrainStarts + pulseTrainLengths - 3]
+    initialSignalStates = (firstStateTransitions - barcodeLeftEdges) / samplingRate < 0.001
+    finalSignalStates = (barcodeRightEdges - finalStateTransitions) / samplingRate < 0.001
+
+    # Replace the wrapper edges with the barcode edges unless the barcode starts (or ends) high
+    edges = stateTransitionIndices.copy()
+    edges[pulseTrainStarts + 1] = barcodeLeftEdges
+    edges[pulseTrainStarts + pulseTrainLengths - 2] = barcodeRightEdges
+    mask = np.logical_and(positions >= 1, positions <= lastPositions - 1)
+    mask[np.logical_and(positions == 1, initialSignalStates[pulseTrainIndices])] = False
+    mask[np.logical_and(positions == lastPositions - 1, finalSignalStates[pulseTrainIndices])] = False
+    edges, edgePulseTrainIndices = edges[mask], pulseTrainIndices[mask]
+
+    # Determine how many bits are stored in each time interval and the signal state during each
+    withinPulseTrain = edgePulseTrainIndices[1:] == edgePulseTrainIndices[:-1]
+    intervals = np.diff(edges)[withinPulseTrain]
+    intervalPulseTrainIndices = edgePulseTrainIndices[1:][withinPulseTrain]
+    intervalPositions = np.arange(intervals.size) - np.searchsorted(
+        intervalPulseTrainIndices,
+        intervalPulseTrainIndices
+    )
+    nBits = np.clip(np.rint(intervals / (barcodeBitSize * samplingRate)).astype(int), 0, None)
+    signalStates = initialSignalStates[intervalPulseTrainIndices] ^ (intervalPositions % 2 == 1)
+
+    # Decode the bits (least significant bit first)
+    nBitsPerPulseTrain = np.bincount(intervalPulseTrainIndices, weights=nBits, minlength=nPulseTrains)
+    if np.any(nBitsPerPulseTrain != 32):
+        raise Exception(f'More or less that 32 bits decoded')
+    bits = np.repeat(signalStates, nBits).reshape(-1, 32).astype(np.int64)
+    values = bits @ (np.int64(1) << np.arange(32, dtype=np.int64))
+
+    # 32-bit integer overflow
+    overflowIndices = np.flatnonzero(values == 2 ** 32 - 1)
+    if overflowIndices.size != 0:
+        values[overflowIndices[0] + 1:] += 2 ** 32
+    indices = stateTransitionIndices[pulseTrainStarts]
+
+    return values, indices
+
+def matchBarcodes(barcodeValuesLabjack, barcodeValuesNeuropixels):
+    """
+    Join the barcodes decoded from each device by value
+
+    Returns an N barcodes x 2 array with the positions of the matched barcodes
+    in each input array (sorted by value) and a report of the barcode values
+    which are duplicated within or missing from either device. Duplicated
+    values are ambiguous so they're left out of the matches
+    """
+
+    #
+    barcodeValuesLabjack = np.asarray(barcodeValuesLabjack)
+    barcodeValuesNeuropixels = np.asarray(barcodeValuesNeuropixels)
+    uniqueValuesLabjack, firstIndicesLabjack, countsLabjack = np.unique(
+        barcodeValuesLabjack,
+        return_index=True,
+        return_counts=True
+    )
+    uniqueValuesNeuropixels, firstIndicesNeuropixels, countsNeuropixels = np.unique(
+        barcodeValuesNeuropixels,
+        return_index=True,
+        return_counts=True
+    )
+
+    # Join the barcodes which show up exactly once on each device
+    sharedValues, iLabjack, iNeuropixels = np.intersect1d(
+        uniqueValuesLabjack[countsLabjack == 1],
+        uniqueValuesNeuropixels[countsNeuropixels == 1],
+        assume_unique=True,
+        return_indices=True
+    )
+    matches = np.column_stack([
+        firstIndicesLabjack[countsLabjack == 1][iLabjack],
+        firstIndicesNeuropixels[countsNeuropixels == 1][iNeuropixels]
+    ])
+
+    # Barcodes missing from one device (between the first and last matched barcodes)
+    if sharedValues.size == 0:
+        lowerBound, upperBound = np.inf, -np.inf
+    else:
+        lowerBound, upperBound = sharedValues[0], sharedValues[-1]
+    missingValuesLabjack = np.setdiff1d(uniqueValuesNeuropixels, uniqueValuesLabjack, assume_unique=True)
+    missingValuesNeuropixels = np.setdiff1d(uniqueValuesLabjack, uniqueValuesNeuropixels, assume_unique=True)
+    report = {
+        'duplicates': {
+            'labjack': uniqueValuesLabjack[countsLabjack > 1],
+            'neuropixels': uniqueValuesNeuropixels[countsNeuropixels > 1]
+        },
+        'missing': {
+            'labjack': missingValuesLabjack[
+                np.logical_and(missingValuesLabjack >= lowerBound, missingValuesLabjack <= upperBound)
+            ],
+            'neuropixels': missingValuesNeuropixels[
+                np.logical_and(missingValuesNeuropixels >= lowerBound, missingValuesNeuropixels <= upperBound)
+            ]
+        }
+    }
+
+    return matches, report
+
+def _fitLinearSpline(x, y, nSegments=1, robust=True, nIterations=20):
+    """
+    Fit a continuous piecewise linear function (knots at quantiles of x) by
+    least squares, using Huber weights if robust is True
+    """
+
+    center, scale = float(np.mean(x)), float(np.std(x) or 1)
+    knots = np.quantile(x, np.linspace(0, 1, nSegments + 1)[1:-1])
+    A = _designMatrix(x, center, scale, knots)
+
+    # Iteratively reweighted least squares
+    weights = np.ones(x.size)
+    for iIteration in range(nIterations if robust else 1):
+        sqrtWeights = np.sqrt(weights)
+        coefficients = np.linalg.lstsq(A * sqrtWeights[:, None], y * sqrtWeights, rcond=None)[0]
+        residuals = y - A @ coefficients
+        sigma = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        if sigma == 0:
+            break
+        weightsUpdated = np.minimum(1, 1.345 * sigma / np.maximum(np.abs(residuals), np.finfo(float).tiny))
+        if np.allclose(weightsUpdated, weights):
+            break
+        weights = weightsUpdated
+
+    model = {
+        'center': center,
+        'scale': scale,
+        'knots': knots.tolist(),
+        'coefficients': coefficients.tolist()
+    }
+
+    return model, residuals
+
+def _designMatrix(x, center, scale, knots):
+    """
+    Intercept, slope, and one hinge function for each knot
+    """
+
+    x = np.asarray(x, dtype=float)
+    A = np.empty((x.size, len(knots) + 2))
+    A[:, 0] = 1
+    np.subtract(x, center, out=A[:, 1])
+    A[:, 1] /= scale
+    for iKnot, knot in enumerate(knots):
+        np.subtract(x, knot, out=A[:, iKnot + 2])
+        A[:, iKnot + 2] /= scale
+        np.maximum(A[:, iKnot + 2], 0, out=A[:, iKnot + 2])
+
+    return A
+
+def _evaluateLinearSpline(model, x):
+    """
+    """
+
+    x = np.asarray(x, dtype=float)
+    coefficients = model['coefficients']
+    y = x - model['center']
+    y *= coefficients[1] / model['scale']
+    y += coefficients[0]
+    for knot, coefficient in zip(model['knots'], coefficients[2:]):
+        y += np.maximum(x - knot, 0) * (coefficient / model['scale'])
+
+    return y
+
+class TimestampGenerator():
+    """
+    Maps labjack sample indices onto the Neuropixels clock (in seconds)
+
+    Both devices record the same barcodes, so the labjack sample indices are
+    mapped onto barcode values and the barcode values onto Neuropixels time,
+    each by a (robust, optionally piecewise) least squares fit
+    """
+
+    def __init__(self, labjackModel=None, neuropixelsModel=None, diagnostics=None):
+        """
+        """
+
+        self.labjackModel = labjackModel
+        self.neuropixelsModel = neuropixelsModel
+        self.diagnostics = diagnostics
+
+        return
+
+    def fit(
+        self,
+        labjackIndices,
+        labjackValues,
+        neuropixelsIndices,
+        neuropixelsValues,
+        nSegments=1,
+        robust=True,
+        ):
+        """
+        Fit the generator to the barcodes decoded from each device (the
+        Neuropixels indices should already be relative to the first sample of
+        the recording)
+        """
+
+        global samplingRateLabjack
+        global samplingRateNeuropoixels
+
+        #
+        labjackIndices = np.asarray(labjackIndices, dtype=float)
+        labjackValues = np.asarray(labjackValues, dtype=float)
+        neuropixelsTimestamps = np.asarray(neuropixelsIndices, dtype=float) / samplingRateNeuropoixels
+        neuropixelsValues = np.asarray(neuropixelsValues, dtype=float)
+        if labjackIndices.size < 2 or neuropixelsValues.size < 2:
+            raise Exception('At least 2 barcodes from each device are needed to fit the timestamp generator')
 
         #
-        values.append(value)
-        indices.append(pulseTrain[0])
+        self.labjackModel, labjackResiduals = _fitLinearSpline(
+            labjackIndices,
+            labjackValues,
+            nSegments,
+            robust
+        )
+        self.neuropixelsModel, neuropixelsResiduals = _fitLinearSpline(
+            neuropixelsValues,
+            neuropixelsTimestamps,
+            nSegments,
+            robust
+        )
+
+        # Express the labjack residuals (barcode values) in seconds
+        secondsPerValue = (neuropixelsTimestamps[-1] - neuropixelsTimestamps[0]) / (neuropixelsValues[-1] - neuropixelsValues[0])
+        labjackResiduals = labjackResiduals * secondsPerValue
+
+        # Drift of the labjack clock relative to the Neuropixels clock
+        t1, t2 = self.convert(labjackIndices[[0, -1]])
+        elapsed = (labjackIndices[-1] - labjackIndices[0]) / samplingRateLabjack
+        self.diagnostics = {
+            'drift': float(((t2 - t1) / elapsed - 1) * 1e6), # ppm
+            'labjackResidualsRMS': float(np.sqrt(np.mean(labjackResiduals ** 2))),
+            'labjackResidualsMax': float(np.max(np.abs(labjackResiduals))),
+            'neuropixelsResidualsRMS': float(np.sqrt(np.mean(neuropixelsResiduals ** 2))),
+            'neuropixelsResidualsMax': float(np.max(np.abs(neuropixelsResiduals))),
+            'nBarcodes': (int(labjackIndices.size), int(neuropixelsValues.size)),
+        }
+
+        return self
+
+    def convert(self, indices):
+        """
+        Compute the timestamps for the labjack sample indices
+        """
+
+        if self.labjackModel is None or self.neuropixelsModel is None:
+            raise Exception('Timestamp generator has not been fit')
+
+        return _evaluateLinearSpline(
+            self.neuropixelsModel,
+            _evaluateLinearSpline(self.labjackModel, indices)
+        )
+
+    def toDict(self):
+        """
+        Represent the generator with built-in types for saving
+        """
+
+        return {
+            'labjack': self.labjackModel,
+            'neuropixels': self.neuropixelsModel,
+            'diagnostics': self.diagnostics
+        }
+
+    @classmethod
+    def fromDict(cls, data):
+        """
+        """
+
+        return cls(data['labjack'], data['neuropixels'], data['diagnostics'])
+
+class LegacyTimestampGenerator():
+    """
+    Timestamp generator for sessions synchronized before TimestampGenerator
+    existed (only the timestampGeneratorParameters entry was saved)
+
+    Labjack sample indices are interpolated onto the zeroed barcode values and
+    then scaled and offset onto the Neuropixels clock exactly as before
+    """
+
+    def __init__(self, parameters):
+        """
+        """
+
+        self.parameters = parameters
+
+        return
+
+    def convert(self, indices):
+        """
+        Compute the timestamps for the labjack sample indices
+        """
 
-    return np.array(values), np.array(indices)
\ No newline at end of file
+        p = self.parameters
+        return np.interp(indices, p['xp'], p['fp']) * p['m'] + p['b']
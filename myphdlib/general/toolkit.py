@@ -1,13 +1,35 @@
 import os
 import sys
 import numpy as np
+import functools
 import pathlib as pl
 import subprocess as sp
 from decimal import Decimal
 from scipy.stats import pearsonr
+from scipy.sparse import csr_matrix
+from scipy.signal import oaconvolve
+from scipy.ndimage import convolve1d
 from scipy.interpolate import Akima1DInterpolator
 
-def smooth(a, window_size=5, window_type='hanning', axis=1):
+# Window sizes at or above this are convolved with overlap-add FFTs
+_directConvolutionLimit = 64
+
+@functools.lru_cache(maxsize=32)
+def _smoothingWindow(window_size, window_type):
+    """
+    Normalized (read-only) smoothing kernel
+    """
+
+    if window_type == 'flat':
+        w = np.ones(window_size, 'd')
+    else:
+        w = getattr(np, window_type)(window_size)
+    w = w / w.sum()
+    w.setflags(write=False)
+
+    return w
+
+def smooth(a, window_size=5, window_type='hanning', axis=1, dtype=None):
     """
     Smooth array by convolving with a sliding window
 
@@ -20,7 +42,10 @@ def smooth(a, window_size=5, window_type='hanning', axis=1):
     window_type
         Type of window to use for smoothing
     axis
-        Axis to smooth across for 2D arrays
+        Axis to smooth across for arrays with 2 or more dimensions
+    dtype
+        Floating point type of the output (defaults to float64, use
+        np.float32 to halve memory usage)
 
     returns
     -------
@@ -34,43 +59,223 @@ def smooth(a, window_size=5, window_type='hanning', axis=1):
     if not window_type in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
         raise ValueError(f'Invalid window type: {window_type}')
 
-    if window_type == 'flat':
-        w = np.ones(window_size,'d')
+    a = np.asarray(a)
+    if a.ndim == 0:
+        raise ValueError('Smoothing not supported for 0-dimensional arrays')
+    if a.ndim == 1:
+        axis = 0
+    if axis < -a.ndim or axis >= a.ndim:
+        raise ValueError(f'Invalid axis for a {a.ndim}-dimensional array: {axis}')
+    axis = axis % a.ndim
+
+    if a.shape[axis] < window_size:
+        if a.ndim == 1:
+            raise ValueError('Input array is smaller than the smoothing window')
+        raise ValueError(f'Size of input array along the {axis} axis is smaller than the smoothing window')
+
+    #
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    w = _smoothingWindow(window_size, window_type).astype(dtype, copy=False)
+
+    # Reflect the signal about its first and last samples
+    padding = [(0, 0)] * a.ndim
+    padding[axis] = (window_size - 1, window_size - 1)
+    padded = np.pad(a.astype(dtype, copy=False), padding, mode='reflect')
+
+    # Centered portion of the valid convolution (NaN or inf samples would
+    # spread across the whole signal through the FFTs, so those are always
+    # convolved directly)
+    offset = int((window_size - 1) / 2)
+    nValid = padded.shape[axis] - window_size + 1
+    index = [slice(None)] * a.ndim
+    if window_size < _directConvolutionLimit or np.isfinite(padded).all() == False:
+        full = convolve1d(padded, w, axis=axis, mode='constant')
+        index[axis] = slice(2 * offset, nValid)
+        a2 = full[tuple(index)]
     else:
-        w = eval('np.' + window_type + f'({window_size})')
+        shape = [1] * a.ndim
+        shape[axis] = window_size
+        valid = oaconvolve(padded, w.reshape(shape), mode='valid', axes=axis)
+        index[axis] = slice(offset, nValid - offset)
+        a2 = valid[tuple(index)].astype(dtype, copy=False)
 
+    return np.ascontiguousarray(a2)
 
-    # One dimension
-    if  a.ndim == 1:
+def filterInChunks(a, function, overlap, chunkSize=1000000, out=None, dtype=np.float64):
+    """
+    Apply a filter to a long signal block by block along its first axis
 
-        if a.size < window_size:
-            raise ValueError('Input array is smaller than the smoothing window')
+    keywords
+    --------
+    a
+        Input array or memory-map (samples along the first axis)
+    function
+        Callable that maps a block of samples onto a filtered block of the
+        same length
+    overlap
+        Number of samples on either side of a block that the filter needs to
+        see to produce the correct output for the block
+    chunkSize
+        Number of output samples computed per block
+    out
+        Array (or memory-map) to write the result into
+    dtype
+        Data type of the output array if out is not specified
+
+    returns
+    -------
+    out
+        Filtered signal
+    """
+
+    overlap = int(overlap)
+    chunkSize = int(chunkSize)
+    if chunkSize < 2 * overlap + 1:
+        raise ValueError(f'Chunk size must be at least {2 * overlap + 1} samples')
+
+    #
+    nSamples = a.shape[0]
+    if out is None:
+        out = np.empty(a.shape, dtype=dtype)
+    elif out.shape != a.shape:
+        raise ValueError('Output array must have the same shape as the input array')
+
+    # Fold a short trailing block into the one before it
+    blockStarts = list(range(0, nSamples, chunkSize))
+    if len(blockStarts) > 1 and nSamples - blockStarts[-1] < 2 * overlap + 1:
+        blockStarts.pop()
+    blockStops = blockStarts[1:] + [nSamples]
+
+    #
+    for start, stop in zip(blockStarts, blockStops):
+        left = max(start - overlap, 0)
+        right = min(stop + overlap, nSamples)
+        filtered = function(np.asarray(a[left: right]))
+        out[start: stop] = filtered[start - left: stop - left]
 
-        s = np.r_[a[window_size - 1: 0: -1], a, a[-2: -window_size - 1: -1]]
-        smoothed = np.convolve(w / w.sum(), s, mode='valid')
-        centered = smoothed[int((window_size - 1) / 2): int(-1 * (window_size - 1) / 2)]
-        a2 = centered
-        return a2
+    return out
 
-    # Two or more dimensions
-    elif a.ndim == 2:
+def smoothInChunks(a, window_size=5, window_type='hanning', chunkSize=1000000, out=None, dtype=None):
+    """
+    Smooth a long 1D or 2D signal along its first axis in fixed-size blocks
 
-        if a.shape[axis] < window_size:
-            raise ValueError(f'Size of input array along the {axis} axis is smaller than the smoothing window')
+    Produces the same result as smooth (including the reflection about the
+    first and last samples) while only holding one block in memory at a time
 
-        a2 = np.full_like(a if axis == 1 else a.T, np.nan)
+    keywords
+    --------
+    a
+        Input array or memory-map (samples along the first axis)
+    window_size
+        Size of the smoothing window (in samples)
+    window_type
+        Type of window to use for smoothing
+    chunkSize
+        Number of output samples computed per block
+    out
+        Array (or memory-map) to write the result into
+    dtype
+        Floating point type of the output
+
+    returns
+    -------
+    out
+        Smoothed signal
+    """
 
-        # Iterate over rows or columns
-        for i, slice in enumerate(a if axis == 1 else a.T):
-            s = np.r_[slice[window_size - 1: 0: -1], slice, slice[-2: -window_size - 1: -1]]
-            smoothed = np.convolve(w / w.sum(), s, mode='valid')
-            centered = smoothed[int((window_size - 1) / 2): int(-1 * (window_size - 1) / 2)]
-            a2[i] = centered
+    if window_size % 2 == 0:
+        raise ValueError('Window size must be odd for chunked smoothing')
 
-        return a2 if axis == 1 else a2.T
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    function = lambda block: smooth(block, window_size, window_type, axis=0, dtype=dtype)
 
+    return filterInChunks(a, function, int((window_size - 1) / 2), chunkSize, out, dtype)
+
+def _findRelativeTimes(target_events, relative_events, window, closed='both', return_indices=False):
+    """
+    Find the relative events that fall within the window around each target
+    event using binary search (instead of subtracting each target event from
+    every relative event)
+
+    returns
+    -------
+    event_indices
+        Index of the target event for each relative time
+    relative_times
+        Relative event timestamps minus the target event timestamp (in the order
+        of the relative events for each target event)
+    relative_indices (optional)
+        Index of the relative event for each relative time
+    """
+
+    target_events = np.asarray(target_events, dtype=float).ravel()
+    relative_events = np.asarray(relative_events, dtype=float).ravel()
+
+    # Sort the relative events (unless they already are)
+    order = None
+    if np.any(relative_events[1:] < relative_events[:-1]):
+        order = np.argsort(relative_events, kind='stable')
+        relative_events = relative_events[order]
+
+    # Find the candidates (the search is widened by a few ulps so that the exact
+    # comparison below decides the events sitting right on the window's edges)
+    magnitude = np.abs(np.concatenate([relative_events[[0, -1]] if relative_events.size else [], target_events])).max(initial=0)
+    tolerance = 16 * np.spacing(magnitude + np.abs(window).max())
+    first = np.searchsorted(relative_events, target_events + window[0] - tolerance, side='left')
+    last = np.searchsorted(relative_events, target_events + window[1] + tolerance, side='right')
+    counts = np.maximum(last - first, 0)
+    event_indices = np.repeat(np.arange(target_events.size), counts)
+    candidate_indices = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - first, counts)
+    relative_times = relative_events[candidate_indices] - target_events[event_indices]
+
+    # Exact comparison with the edges of the window
+    lower = relative_times >= window[0] if closed in ('both', 'left') else relative_times > window[0]
+    upper = relative_times <= window[1] if closed in ('both', 'right') else relative_times < window[1]
+    mask = np.logical_and(lower, upper)
+    event_indices, relative_times = event_indices[mask], relative_times[mask]
+    relative_indices = candidate_indices[mask]
+
+    # Restore the original order of the relative events
+    if order is not None:
+        relative_indices = order[relative_indices]
+        resorted = np.lexsort([relative_indices, event_indices])
+        event_indices, relative_times = event_indices[resorted], relative_times[resorted]
+        relative_indices = relative_indices[resorted]
+
+    if return_indices:
+        return event_indices, relative_times, relative_indices
     else:
-        raise ValueError('Smoothing not supported for arrays of 3 or more dimensions')
+        return event_indices, relative_times
+
+def _histogramRelativeTimes(event_indices, relative_times, n_events, edges):
+    """
+    Count the relative times in each bin for each target event (same bins as
+    numpy.histogram, i.e., [left, right) except for the last bin which is
+    [left, right])
+    """
+
+    n_bins = len(edges) - 1
+    bin_indices, mask = _digitizeRelativeTimes(relative_times, edges)
+    counts = np.bincount(
+        event_indices[mask] * n_bins + bin_indices[mask],
+        minlength=n_events * n_bins
+    )
+
+    return counts.reshape(n_events, n_bins)
+
+def _digitizeRelativeTimes(relative_times, edges):
+    """
+    Find the bin for each relative time (same bins as numpy.histogram) and a
+    mask for the relative times that fall within the edges
+    """
+
+    edges = np.asarray(edges, dtype=float)
+    n_bins = edges.size - 1
+    bin_indices = np.searchsorted(edges, relative_times, side='right') - 1
+    bin_indices[relative_times == edges[-1]] = n_bins - 1
+    mask = np.logical_and(bin_indices >= 0, bin_indices < n_bins)
+
+    return bin_indices, mask
 
 def psth(target_events, relative_events, binsize=0.01, window=(-0.5, 1), edges=None, return_relative_times=False):
     """
@@ -113,21 +318,9 @@ def psth(target_events, relative_events, binsize=0.01, window=(-0.5, 1), edges=N
         nbins = int(range / binsize) + 1
         edges = np.linspace(start, stop, nbins)
 
-        #
-        relative_times = list()
-
         # Create the histogram matrix M
-        M = list()
-        for iev, target_event in enumerate(target_events):
-            referenced = relative_events - target_event
-            within_window_mask = np.logical_and(referenced > start, referenced <= stop)
-            if return_relative_times:
-                for relative_time in referenced[within_window_mask]:
-                    relative_times.append(relative_time)
-            counts, edges_ = np.histogram(referenced[within_window_mask], bins=edges)
-            M.append(counts)
-
-        M = np.array(M).astype(int)
+        event_indices, relative_times = _findRelativeTimes(target_events, relative_events, (start, stop), closed='right')
+        M = _histogramRelativeTimes(event_indices, relative_times, np.size(target_events), edges).astype(int)
 
     # Unequally sized bins
     else:
@@ -136,33 +329,24 @@ def psth(target_events, relative_events, binsize=0.01, window=(-0.5, 1), edges=N
         if len(edges) < 2:
             raise ValueError('List of edges must specify at least 1 bin')
 
-        # Compute bin edges and the range of the time window
-        left_bin_edges  = edges[:-1]
-        right_bin_edges = edges[1:]
-        left_most_edge  = left_bin_edges[0]
-        right_most_edge = right_bin_edges[-1]
+        # Convert edges to numpy array
+        if type(edges) != np.ndarray:
+            edges = np.array(edges)
 
-        # Empty matrix
-        M = np.zeros((target_events.size, len(edges) - 1), dtype=int)
-
-        # For each target event ...
-        for iev, target_event in enumerate(target_events):
-            referenced = relative_events - target_event
-            within_window_mask = np.logical_and(referenced > left_most_edge, referenced <= right_most_edge)
-
-            # For each target bin ...
-            for ibin, (left_bin_edge, right_bin_edge) in enumerate(zip(left_bin_edges, right_bin_edges)):
-
-                # For each relative event in the target window
-                for relative_event in referenced[within_window_mask]:
-
-                    # Check if relative event is in the target bin
-                    if left_bin_edge < relative_event <= right_bin_edge:
-                        M[iev, ibin] += 1
+        # Find the relative events in the window (left-most edge, right-most edge]
+        event_indices, relative_times = _findRelativeTimes(
+            target_events,
+            relative_events,
+            (edges[0], edges[-1]),
+            closed='right'
+        )
 
-            # Convert edges to numpy array
-            if type(edges) != np.ndarray:
-                edges = np.array(edges)
+        # Bins are open on the left and closed on the right, i.e., (left, right]
+        bin_indices = np.searchsorted(edges, relative_times, side='left') - 1
+        M = np.bincount(
+            event_indices * (edges.size - 1) + bin_indices,
+            minlength=np.size(target_events) * (edges.size - 1)
+        ).reshape(np.size(target_events), edges.size - 1).astype(int)
 
     if return_relative_times:
         return edges, np.array(relative_times)
@@ -170,13 +354,14 @@ def psth(target_events, relative_events, binsize=0.01, window=(-0.5, 1), edges=N
     else:
         return edges, M
 
-def psth2(event1, event2, window=(-1, 1), binsize=None, returnZeroIndex=False):
+def _computeBinEdges(window=(-1, 1), binsize=None):
     """
+    Compute the bin edges, bin centers, and the index of the bin at time zero
+    used by psth2 and populationPsth
     """
 
     # Case of a single bin
     if binsize is None:
-        nBins = 1
         binEdges = window
         t = window[0] + np.diff(window).item() / 2
         i = None
@@ -201,16 +386,16 @@ def psth2(event1, event2, window=(-1, 1), binsize=None, returnZeroIndex=False):
         left = right - 1
         i = int((left + right) / 2)
 
+    return binEdges, t, i
+
+def psth2(event1, event2, window=(-1, 1), binsize=None, returnZeroIndex=False):
+    """
+    """
+
     #
-    M = np.full([event1.size, nBins], np.nan)
-    for rowIndex, timestamp in enumerate(event1):
-        relative = event2 - timestamp
-        withinWindowMask = np.logical_and(
-            relative >= window[0],
-            relative <= window[1]
-        )
-        binCounts, binEdges = np.histogram(relative[withinWindowMask], bins=binEdges)
-        M[rowIndex, :] = binCounts
+    binEdges, t, i = _computeBinEdges(window, binsize)
+    eventIndices, relativeTimes = _findRelativeTimes(event1, event2, window, closed='both')
+    M = _histogramRelativeTimes(eventIndices, relativeTimes, event1.size, binEdges).astype(float)
 
     #
     if returnZeroIndex:
@@ -218,6 +403,94 @@ def psth2(event1, event2, window=(-1, 1), binsize=None, returnZeroIndex=False):
     else:
         return t, M
 
+def populationPsth(spikeTimes, spikeClusters, events, window=(-1, 1), binsize=None, clusters=None, sparse=False, closed='both'):
+    """
+    Compute the PSTHs of every unit at once
+
+    keywords
+    --------
+    spikeTimes
+        Timestamps (in seconds) of every spike in the session (sorted or not)
+    spikeClusters
+        Cluster number for each spike
+    events
+        Timestamps (in seconds) of the events, or a list of timestamp arrays
+    window
+        Time window (in seconds), or a list of windows (one per event array)
+    binsize
+        Binsize (in seconds), None for a single bin (same bins as psth2)
+    clusters
+        Cluster numbers of the units (rows) in the output; defaults to every
+        cluster in spikeClusters (sorted)
+    sparse
+        Return a scipy.sparse CSR matrix of shape units x (events * bins)
+        instead of the dense array
+    closed
+        Which edges of the window are inclusive ('both' like psth2, 'right'
+        like psth)
+
+    returns
+    -------
+    t
+        Bin centers (in seconds)
+    M
+        Spike counts of the shape units x events x bins
+    """
+
+    # Multiple event arrays
+    if isinstance(events, (list, tuple)):
+        windows = window if isinstance(window, list) else [window] * len(events)
+        results = [
+            populationPsth(spikeTimes, spikeClusters, events_, window_, binsize, clusters, sparse, closed)
+                for events_, window_ in zip(events, windows)
+        ]
+        return [t for t, M in results], [M for t, M in results]
+
+    #
+    spikeClusters = np.asarray(spikeClusters).ravel()
+    if clusters is None:
+        clusters = np.unique(spikeClusters)
+    clusters = np.asarray(clusters)
+    events = np.asarray(events, dtype=float).ravel()
+    binEdges, t, i = _computeBinEdges(window, binsize)
+    nUnits, nEvents, nBins = clusters.size, events.size, len(binEdges) - 1
+
+    # Find every spike within the window around every event
+    eventIndices, relativeTimes, spikeIndices = _findRelativeTimes(
+        events,
+        spikeTimes,
+        window,
+        closed=closed,
+        return_indices=True
+    )
+
+    # Map the spikes onto rows (units) and drop spikes from other clusters
+    clusterOrder = np.argsort(clusters, kind='stable')
+    sortedClusters = clusters[clusterOrder]
+    rowIndices = np.minimum(np.searchsorted(sortedClusters, spikeClusters[spikeIndices]), max(nUnits - 1, 0))
+    binIndices, mask = _digitizeRelativeTimes(relativeTimes, binEdges)
+    if nUnits != 0:
+        mask &= sortedClusters[rowIndices] == spikeClusters[spikeIndices]
+    else:
+        mask[:] = False
+    rowIndices = clusterOrder[rowIndices[mask]]
+    columnIndices = eventIndices[mask] * nBins + binIndices[mask]
+
+    #
+    if sparse:
+        M = csr_matrix(
+            (np.ones(rowIndices.size, dtype=int), (rowIndices, columnIndices)),
+            shape=(nUnits, nEvents * nBins)
+        )
+        M.sum_duplicates()
+    else:
+        M = np.bincount(
+            rowIndices * (nEvents * nBins) + columnIndices,
+            minlength=nUnits * nEvents * nBins
+        ).reshape(nUnits, nEvents, nBins)
+
+    return t, M
+
 def detectThresholdCrossing(a, threshold, timeout=None):
     """
     Determine where a threshold was crossing in a time series (agnostic of
@@ -229,24 +502,42 @@ def detectThresholdCrossing(a, threshold, timeout=None):
     crossings[0] = False
     indices = np.argwhere(crossings).flatten()
 
-    # Get rid of crossings that happen in the refractory period
-    if timeout != None:
-        while True:
-            intervals = np.diff(indices)
-            sizeBeforeFiltering = indices.size
-            for counter, interval in enumerate(intervals):
-                if interval <= timeout:
-                    indices = np.delete(indices, counter + 1)
-                    break
-            sizeAfterFiltering = indices.size
-            loss = sizeAfterFiltering - sizeBeforeFiltering
-            if loss == 0:
-                break
+    # Get rid of crossings that happen in the refractory period (each kept
+    # crossing is followed by the first crossing past its timeout)
+    if timeout is not None and indices.size > 1:
+        following = np.searchsorted(indices, indices + timeout, side='right').tolist()
+        keep = list()
+        i = 0
+        while i < indices.size:
+            keep.append(i)
+            i = following[i]
+        indices = indices[keep]
 
     return indices
 
-def interpolate(a, axis=0):
+def interpolate(a, axis=0, maximumGapSize=None):
     """
+    Fill NaN values by linear interpolation
+
+    keywords
+    --------
+    a
+        1D or 2D input array
+    axis
+        Interpolate within each row (0) or within each column (1)
+    maximumGapSize
+        Longest run of NaN values to fill (in samples), longer gaps are left
+        as NaN
+
+    returns
+    -------
+    b
+        Copy of the input with the gaps filled
+
+    notes
+    -----
+    Leading and trailing NaN values take on the nearest valid value (like
+    np.interp) and rows (or columns) that are entirely NaN are left as is
     """
 
     if len(a.shape) == 1:
@@ -256,26 +547,41 @@ def interpolate(a, axis=0):
     else:
         raise Exception('Interpolation of arrays with > 2 dimensions not supported')
 
-    M, N = a.shape
-
-    b = np.copy(a)
-    if axis == 0:
-        for iM in range(M):
-            mask = np.isnan(a[iM, :])
-            x = np.where(mask)[0]
-            xp = np.where(np.invert(mask))[0]
-            fp = a[iM, np.invert(mask)]
-            estimates = np.interp(x, xp, fp)
-            b[iM, mask] = estimates
-    elif axis == 1:
-        for iN in range(N):
-            mask = np.isnan(a[:, iN])
-            x = np.where(mask)[0]
-            xp = np.where(np.invert(mask))[0]
-            fp = a[np.invert(mask), iN]
-            estimates = np.interp(x, xp, fp)
-            b[mask, iN] = estimates
+    # Gaps are filled within rows of a C-contiguous copy
+    b = np.array(a if axis == 0 else a.T, order='C')
+    mask = np.isnan(b)
+    if mask.any() and not mask.all():
+
+        # Offset each row by its length so that one call to np.interp covers
+        # every row, then fix up the samples outside of each row's valid range
+        M, N = b.shape
+        valid = np.invert(mask)
+        flattened = b.reshape(-1)
+        x = np.flatnonzero(mask)
+        xp = np.flatnonzero(valid)
+        estimates = np.interp(x, xp, flattened[xp])
+        rowIndices, columnIndices = np.divmod(x, N)
+
+        # Leading and trailing gaps take on the nearest valid value
+        firstValidIndices = valid.argmax(1)
+        lastValidIndices = N - 1 - valid[:, ::-1].argmax(1)
+        leading = columnIndices < firstValidIndices[rowIndices]
+        trailing = columnIndices > lastValidIndices[rowIndices]
+        estimates[leading] = flattened[rowIndices[leading] * N + firstValidIndices[rowIndices[leading]]]
+        estimates[trailing] = flattened[rowIndices[trailing] * N + lastValidIndices[rowIndices[trailing]]]
+
+        # Skip rows without any valid samples and gaps which are too long
+        include = valid.any(1)[rowIndices]
+        if maximumGapSize is not None:
+            i = np.searchsorted(xp, x)
+            x0 = np.where(leading, rowIndices * N - 1, xp[np.clip(i - 1, 0, None)])
+            x1 = np.where(trailing, rowIndices * N + N, xp[np.clip(i, None, xp.size - 1)])
+            include &= (x1 - x0 - 1) <= maximumGapSize
+        flattened[x[include]] = estimates[include]
 
+    #
+    if axis != 0:
+        b = b.T
     if b.shape[0] == 1:
         return b.flatten()
     else:
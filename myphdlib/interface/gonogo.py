@@ -4,12 +4,12 @@ import pandas as pd
 import pathlib as pl
 from myphdlib.interface.session import SessionBase
 from myphdlib.general.labjack import loadLabjackData
-from myphdlib.general.labjack import extractLabjackEvent
+from myphdlib.general.labjack import extractLabjackEvents
 from myphdlib.extensions.deeplabcut import loadBodypartData
 import scipy as sp
 from matplotlib import pylab as plt
 from scipy.signal import savgol_filter
-from myphdlib.general.labjack import filterPulsesFromPhotologicDevice
+from myphdlib.general.labjack import debounceDigitalSignal
 
 
 class GonogoSession(SessionBase):
@@ -134,13 +134,13 @@ class GonogoSession(SessionBase):
         Extract timestamps of probes from Labjack data and return probe timestamps
         """
         labjackDirectory = self.labjackFolder
-        labjackData = loadLabjackData(labjackDirectory)
+        labjackData = loadLabjackData(labjackDirectory, channels=(0, 6))
         timestamps = labjackData[:, 0]
-        # probeOnset, probeIndices = extractLabjackEvent(labjackData, 6, edge = 'rising')
-        filtered = filterPulsesFromPhotologicDevice(labjackData[:, 6],
-            minimumPulseWidthInSeconds=pulseFilter
+        # probeOnset, probeIndices = extractLabjackEvent(labjackData, 1, edge = 'rising')
+        filtered, edgeIndices = debounceDigitalSignal(labjackData[:, 1],
+            round(pulseFilter * 1000, 2)
         )
-        probeIndices = np.where(np.diff(filtered) > 0.5)[0]
+        probeIndices = edgeIndices[filtered[edgeIndices + 1] > 0.5]
         probeTimestamps = timestamps[probeIndices]
         self.write(probeTimestamps, 'probeTimestamps')
         return
@@ -159,9 +159,9 @@ class GonogoSession(SessionBase):
         Extract timestamps of frames from Labjack data and return frame timestamps
         """
         labjackDirectory = self.labjackFolder
-        labjackData = loadLabjackData(labjackDirectory)
+        labjackData = loadLabjackData(labjackDirectory, channels=(0, 7))
         timestamps = labjackData[:, 0]
-        frameOnset, frameIndices = extractLabjackEvent(labjackData, 7, edge = 'both')
+        frameIndices, = extractLabjackEvents(labjackData, [{'channel': 1, 'edge': 'both'}])
         frameTimestamps = timestamps[frameIndices]
         self.write(frameTimestamps, 'frameTimestamps')
         return
@@ -171,9 +171,9 @@ class GonogoSession(SessionBase):
         Extract timestamps of frames from Labjack data and return frame timestamps
         """
         labjackDirectory = self.labjackFolder
-        labjackData = loadLabjackData(labjackDirectory)
+        labjackData = loadLabjackData(labjackDirectory, channels=(0, 8))
         timestamps = labjackData[:, 0]
-        puffOnset, puffIndices = extractLabjackEvent(labjackData, 8, edge = 'rising')
+        puffIndices, = extractLabjackEvents(labjackData, [{'channel': 1, 'edge': 'rising'}])
         puffTimestamps = timestamps[puffIndices]
         self.write(puffTimestamps, 'puffTimestamps')
         return
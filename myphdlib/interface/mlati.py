@@ -1,6 +1,6 @@
 import numpy as np
 from myphdlib.interface.session import SessionBase
-from myphdlib.general.labjack import loadLabjackData, filterPulsesFromPhotologicDevice
+from myphdlib.general.labjack import loadLabjackData, debounceDigitalSignal
 
 class MlatiSession(SessionBase):
     """
@@ -10,11 +10,9 @@ class MlatiSession(SessionBase):
         """
         """
 
-        data = loadLabjackData(self.folders.labjack)
-        signal = filterPulsesFromPhotologicDevice(data[:, 7], minimumPulseWidthInSeconds=0.0167)
-        stateTransitionIndices = np.where(
-            np.abs(np.diff(signal)) > 0.5
-        )[0]
+        # Float so that empty or corrupt files (NaN blocks) don't raise
+        data = loadLabjackData(self.folders.labjack, channels=7, dtype=np.float32)
+        signal, stateTransitionIndices = debounceDigitalSignal(data, round(0.0167 * 1000, 2))
         longestIntervalIndices = np.where(
             np.diff(stateTransitionIndices) / 1000 > 2
         )[0][:5]
@@ -1,7 +1,153 @@
+import os
+import sys
+import copy
 import pickle
 import pathlib as pl
+import numpy as np
 from datetime import date
 from types import SimpleNamespace
+from collections import OrderedDict
+from myphdlib.general.storage import OutputLog, migrateOutputLog
+
+# Marks cache misses (None is a valid value)
+_missing = object()
+
+def _estimateSize(obj):
+    """
+    Rough estimate of the memory used by a (nested) object in bytes
+    """
+
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum([_estimateSize(value) for value in obj.values()])
+    elif isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum([_estimateSize(value) for value in obj])
+    else:
+        return sys.getsizeof(obj)
+
+class ReadCache():
+    """
+    Least-recently-used cache of decoded session data shared by all sessions
+
+    Entries are stored under a name (e.g., the path to an output file) along
+    with a signature (e.g., the file's modification time and size) and are
+    only returned if the signature still matches. The key list of each
+    pickled output file is kept separately (it is small) so that it survives
+    the eviction of the file's data
+    """
+
+    def __init__(self, maximumSize=2 * 1024 ** 3):
+        """
+        """
+
+        self.maximumSize = maximumSize
+        self._entries = OrderedDict()
+        self._keys = dict()
+        self._size = 0
+
+        return
+
+    def _signature(self, filePath):
+        stat = os.stat(filePath)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, name, signature, default=None):
+        """
+        Return a cached value if its signature matches
+        """
+
+        if name in self._entries:
+            signature_, value, size = self._entries[name]
+            if signature_ == signature:
+                self._entries.move_to_end(name)
+                return value
+            self.invalidate(name)
+
+        return default
+
+    def put(self, name, signature, value):
+        """
+        Cache a value (values which would not fit are not kept)
+        """
+
+        self.invalidate(name)
+        size = _estimateSize(value)
+        if size > self.maximumSize:
+            return
+        self._entries[name] = (signature, value, size)
+        self._size += size
+
+        # Evict the least recently used entries
+        while self._size > self.maximumSize:
+            name_, (signature_, value_, size_) = self._entries.popitem(last=False)
+            self._size -= size_
+
+        return
+
+    def container(self, filePath):
+        """
+        Return a decoded output file (loaded from disk if necessary)
+        """
+
+        filePath = str(filePath)
+        signature = self._signature(filePath)
+        container = self.get(filePath, signature)
+        if container is None:
+            with open(filePath, 'rb') as stream:
+                try:
+                    container = pickle.load(stream)
+                except EOFError:
+                    raise Exception(f'Ouptut file is corrupted') from None
+            self.update(filePath, container, signature)
+
+        return container
+
+    def keys(self, filePath):
+        """
+        Return the keys in an output file (without decoding it if possible)
+        """
+
+        filePath = str(filePath)
+        signature = self._signature(filePath)
+        if filePath in self._keys and self._keys[filePath][0] == signature:
+            return list(self._keys[filePath][1])
+
+        return list(self.container(filePath).keys())
+
+    def update(self, filePath, container, signature=None):
+        """
+        Record the contents of an output file (e.g., right after writing it)
+        """
+
+        filePath = str(filePath)
+        if signature is None:
+            signature = self._signature(filePath)
+        self.put(filePath, signature, container)
+        self._keys[filePath] = (signature, list(container.keys()))
+
+        return
+
+    def invalidate(self, name):
+        """
+        Forget an entry
+        """
+
+        if name in self._entries:
+            signature, value, size = self._entries.pop(name)
+            self._size -= size
+        self._keys.pop(name, None)
+
+        return
+
+    def clear(self):
+        self._entries.clear()
+        self._keys.clear()
+        self._size = 0
+        return
+
+# Shared by every session (set readCache.maximumSize to change the bound)
+readCache = ReadCache()
 
 def updateSessionMetadata(session, key, value, intitialize=True):
     """
@@ -85,6 +231,7 @@ class SessionBase(object):
         #
         self._eye = eye
         self._folders = None
+        self._outputLog = None
 
         return
     
@@ -113,28 +260,59 @@ class SessionBase(object):
         
         return
     
-    def write(self, obj, key, initialize=True):
+    def _openOutputLog(self, initialize=True):
         """
+        Return the session's output log or None if the session still uses a
+        pickled output file (see migrate)
         """
 
-        # TODO: Make this fail safe such that a R/W error doesn't corrupt the output files
+        log = self.outputLog
+        if log.exists():
+            return log
+        if self.outputFilePath.exists():
+            return None
 
         #
-        if self.outputFilePath.exists() == False:
-            if initialize:
-                with open(str(self.outputFilePath), 'wb') as stream:
-                    pass
-            else:
-                raise Exception('Could not locate output file')
+        if initialize:
+            log.initialize()
+        else:
+            raise Exception('Could not locate output file')
 
-        #
-        with open(str(self.outputFilePath), 'rb') as stream:
-            try:
-                container = pickle.load(stream)
-            except EOFError:
-                container = dict()
+        return log
+
+    def migrate(self, removeOutputFile=False):
+        """
+        Move the contents of the pickled output file into an output log
+        """
+
+        log = migrateOutputLog(self.outputFilePath, self.outputLog.indexFilePath, removeOutputFile)
+        readCache.invalidate(str(self.outputFilePath))
+        self._outputLog = log
+
+        return log
+
+    def write(self, obj, key, initialize=True):
+        """
+        Save a single key (appended to the output log)
+        """
+
+        log = self._openOutputLog(initialize)
+        if log is not None:
+            log.write(key, obj)
+
+            # Cache a copy so that later changes to obj don't leak into reads
+            readCache.put((str(log.indexFilePath), key), log.locate(key), copy.deepcopy(obj))
+
+            return
+
+        # Pickled output file
+        if self.outputFilePath.stat().st_size == 0:
+            container = dict()
+        else:
+            container = dict(readCache.container(self.outputFilePath))
 
         # TODO: Wait to delete the output file until it passes a check
+        readCache.invalidate(str(self.outputFilePath))
         self.outputFilePath.unlink() 
 
         #
@@ -142,25 +320,36 @@ class SessionBase(object):
         with open(str(self.outputFilePath), 'wb') as stream:
             pickle.dump(container, stream)
 
+        # Cache a copy so that later changes to obj don't leak into reads
+        container[key] = copy.deepcopy(obj)
+        readCache.update(self.outputFilePath, container)
+
         return
     
     def read(self, key):
         """
+        Read a single key (served from memory unless the output changed)
         """
 
+        # Output log
+        log = self.outputLog
+        if log.exists():
+            location = log.locate(key)
+            value = readCache.get((str(log.indexFilePath), key), location, _missing)
+            if value is _missing:
+                value = log.read(key)
+                readCache.put((str(log.indexFilePath), key), location, value)
+            return copy.deepcopy(value)
+
+        # Pickled output file
         if self.outputFilePath.exists() == False:
             raise Exception('Could not locate output file')
 
-        with open(self.outputFilePath, 'rb') as stream:
-            try:
-                container = pickle.load(stream)
-            except EOFError as error:
-                raise Exception(f'Ouptut file is corrupted') from None
-
+        container = readCache.container(self.outputFilePath)
         if key not in container.keys():
             raise Exception(f'Invalid key: {key}')
         else:
-            return container[key]
+            return copy.deepcopy(container[key])
     
     def delete(self, key):
         """
@@ -169,42 +358,39 @@ class SessionBase(object):
         if key not in self.keys():
             raise Exception(f'{key} is not a valid key')
 
-        if self.outputFilePath.exists() == False:
-            raise Exception('Could not locate output file')
+        log = self._openOutputLog(initialize=False)
+        if log is not None:
+            log.delete(key)
+            readCache.invalidate((str(log.indexFilePath), key))
+            return
 
-        with open(self.outputFilePath, 'rb') as stream:
-            try:
-                container = pickle.load(stream)
-            except EOFError as error:
-                raise Exception(f'Ouptut file is corrupted') from None
-            
-        #
+        # Pickled output file
+        container = readCache.container(self.outputFilePath)
         container_ = dict()
         for key_, value_ in container.items():
             if key_ == key:
                 continue
             container_[key_] = value_
+        readCache.invalidate(str(self.outputFilePath))
         self.outputFilePath.unlink()
         with open(str(self.outputFilePath), 'wb') as stream:
             pickle.dump(container_, stream)
+        readCache.update(self.outputFilePath, container_)
 
         return
     
     def keys(self):
         """
-        Return a list of the keys in the output.pkl file
+        Return a list of the keys in the session's output
         """
 
+        if self.outputLog.exists():
+            return self.outputLog.keys()
+
         if self.outputFilePath.exists() == False:
             raise Exception('Could not locate output file')
 
-        with open(self.outputFilePath, 'rb') as stream:
-            try:
-                container = pickle.load(stream)
-            except EOFError as error:
-                raise Exception(f'Ouptut file is corrupted') from None
-            
-        return list(container.keys())
+        return readCache.keys(self.outputFilePath)
     
     @property
     def leftCameraMovie(self): return
@@ -221,6 +407,12 @@ class SessionBase(object):
     @property
     def outputFilePath(self):
         return self.sessionFolderPath.joinpath('output.pkl')
+
+    @property
+    def outputLog(self):
+        if self._outputLog is None:
+            self._outputLog = OutputLog(self.sessionFolderPath.joinpath('output.index'))
+        return self._outputLog
     
     @property
     def videosFolderPath(self):
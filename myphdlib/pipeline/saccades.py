@@ -61,27 +61,25 @@ def extractEyePosition(session, likelihoodThreshold=0.99, pupilCenterName='pupil
 
     return
 
-def correctEyePosition(session, pad=1e6):
+def correctEyePosition(session):
     """
     Correct eye position data for missing/dropped frames
     """
 
     #
     eyePositionUncorrected = session.eyePositionUncorrected
-    nSamples = eyePositionUncorrected.shape[0] + int(pad)
-    eyePositionCorrected = np.full([nSamples, 4], np.nan)
+    nFrames = eyePositionUncorrected.shape[0]
 
-    #
+    # Determine where each frame lands once dropped frames are accounted for
     terminationIndex = 0
     expectedFrameInterval = 1 / session.fps * 1000 # In ms
+    frameIndicesCorrected = dict()
     for camera in ('left', 'right'):
 
         #
         if camera == 'left':
-            columnIndices = 0, 1
             frameIntervals = np.loadtxt(session.leftCameraTimestamps, dtype=np.int64) / 1000000 # In ms
         else:
-            columnIndices = 2, 3
             frameIntervals = np.loadtxt(session.rightCameraTimestamps, dtype=np.int64) / 1000000 # In ms
 
         # TODO: Figure out if I should save these data
@@ -90,31 +88,30 @@ def correctEyePosition(session, pad=1e6):
         # frameTimestamps[1:] = np.cumsum(frameIntervals)
 
         #
-        frameIndex = 0
-        frameOffset = 0
-        missingFrames = 0
-        try:
-            eyePositionUncorrected[0, columnIndices] = eyePositionUncorrected[0, columnIndices]
-        except:
-            import pdb; pdb.set_trace()
-        for frameInterval in frameIntervals:
-            frameOffset += round(frameInterval / expectedFrameInterval) - 1
-            if frameIndex >= eyePositionUncorrected.shape[0]:
-                missingFrames += 1
-            else:
-                eyePositionCorrected[frameIndex + frameOffset, columnIndices] = eyePositionUncorrected[frameIndex, columnIndices]
-            frameIndex += 1
+        frameOffsets = np.cumsum(np.round(np.atleast_1d(frameIntervals) / expectedFrameInterval).astype(np.int64) - 1)
+        frameIndices = np.arange(frameOffsets.size)
+        frameOffset = int(frameOffsets[-1]) if frameOffsets.size else 0
+        missingFrames = max(frameOffsets.size - nFrames, 0)
+        frameIndicesCorrected[camera] = (frameIndices + frameOffsets)[:nFrames]
 
         #
-        if frameIndex + frameOffset > terminationIndex:
-            terminationIndex = frameIndex + frameOffset
+        if frameOffsets.size + frameOffset > terminationIndex:
+            terminationIndex = frameOffsets.size + frameOffset
 
         #
         print(f'INFO[animal={session.animal}, date={session.date}]: {frameOffset} dropped frames detected in the {camera} camera recording')
         print(f'INFO[animal={session.animal}, date={session.date}]: {missingFrames} missing frames detected in the {camera} camera recording')
 
+    # Allocate exactly as many samples as the corrected recording spans (frames
+    # which land outside of it, e.g., at -1 if the first interval rounds to 0,
+    # are dropped instead of wrapping around)
+    eyePositionCorrected = np.full([terminationIndex, 4], np.nan)
+    for camera, columnSlice in zip(('left', 'right'), (slice(0, 2), slice(2, 4))):
+        frameIndices = frameIndicesCorrected[camera]
+        valid = np.logical_and(frameIndices >= 0, frameIndices < terminationIndex)
+        eyePositionCorrected[frameIndices[valid], columnSlice] = eyePositionUncorrected[:frameIndices.size][valid, columnSlice]
+
     #
-    eyePositionCorrected = eyePositionCorrected[:terminationIndex, :]
     session.write(eyePositionCorrected, 'eyePositionCorrected')
 
     return
@@ -238,26 +235,16 @@ def filterEyePosition(session, t=25):
     # Filter
     eyePositionReoriented = session.eyePositionReoriented
     eyePositionFiltered = np.full_like(eyePositionReoriented, np.nan)
-    for columnIndex in range(eyePositionReoriented.shape[1]):
-
-        #
-        if np.isnan(eyePositionReoriented[:, columnIndex]).all():
-            continue
-
-        # Interpolate missing values
-        interpolated = interpolate(eyePositionReoriented[:, columnIndex])
+    columnMask = np.invert(np.isnan(eyePositionReoriented).all(0))
+    if columnMask.any():
 
-        #
-        smoothed = smooth(interpolated, smoothingWindowSize)
-
-        #
-        if columnIndex in (0, 1):
-            smoothed[missingDataMask['left']] = np.nan
-        else:
-            smoothed[missingDataMask['right']] = np.nan
+        # Interpolate missing values and smooth every column at once
+        interpolated = interpolate(eyePositionReoriented[:, columnMask], axis=1)
+        eyePositionFiltered[:, columnMask] = smooth(interpolated, smoothingWindowSize, axis=0)
 
         #
-        eyePositionFiltered[:, columnIndex] = smoothed
+        eyePositionFiltered[missingDataMask['left'], 0:2] = np.nan
+        eyePositionFiltered[missingDataMask['right'], 2:4] = np.nan
 
     # Save filtered eye position data
     session.write(eyePositionFiltered, 'eyePositionFiltered')
@@ -298,20 +285,7 @@ def detectPutativeSaccades(
     #
     # TODO: Reorganize the data container
     eyePositionFiltered = session.read('eyePositionFiltered')
-    eyePositionImputed = np.full_like(eyePositionFiltered, np.nan)
-    for iColumn, column in enumerate(eyePositionFiltered.T):
-
-        # Skip over columns that are entirely NaNs
-        if np.isnan(column).all():
-            eyePositionImputed[:, iColumn] = column
-            continue
-
-        # Impute missing data
-        eyePositionImputed[:, iColumn] = np.interp(
-            np.arange(column.size),
-            np.arange(column.size)[np.isfinite(column)],
-            column[np.isfinite(column)]
-        )
+    eyePositionImputed = interpolate(eyePositionFiltered, axis=1)
     saccadeDetectionResults = {
         'waveforms': {
             'left': list(),